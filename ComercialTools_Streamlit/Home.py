@@ -1,6 +1,6 @@
 import os
 import streamlit as st
-from utils.core import cargar_ubigeo_local, cargar_tabla_ubigeo_excel_bytes
+from utils.core import cargar_ubigeo_local, cargar_tabla_ubigeo_excel_bytes, indexar_ubigeo
 
 st.set_page_config(page_title="ComercialTools – 2025", page_icon="🧰", layout="wide")
 st.title("🧰 ComercialTools – 2025 (Streamlit)")
@@ -17,6 +17,7 @@ UBIGEO_CANDIDATOS = [
 # Estado inicial
 st.session_state.setdefault("ubigeo_ready", False)
 st.session_state.setdefault("ubigeo_df", None)
+st.session_state.setdefault("ubigeo_index", None)   # (Dep, Prov, Dist) -> Ubigeo
 
 # -----------------------------------
 # 1) AUTO–CARGA: Ubigeo local primero
@@ -29,6 +30,7 @@ def _autocargar_ubigeo() -> bool:
                 df = cargar_ubigeo_local(path)
                 if df is not None and not df.empty:
                     st.session_state["ubigeo_df"] = df
+                    st.session_state["ubigeo_index"] = indexar_ubigeo(df)
                     st.session_state["ubigeo_ready"] = True
                     st.success(f"Ubigeo local cargado ✔  (origen: `{path}`, filas: {len(df)})")
                     return True
@@ -39,6 +41,7 @@ def _autocargar_ubigeo() -> bool:
                 df = pd.read_parquet(path)
                 if df is not None and not df.empty:
                     st.session_state["ubigeo_df"] = df
+                    st.session_state["ubigeo_index"] = indexar_ubigeo(df)
                     st.session_state["ubigeo_ready"] = True
                     st.success(f"Ubigeo (cache) cargado ✔  (origen: `{path}`, filas: {len(df)})")
                     return True
@@ -64,6 +67,7 @@ if not st.session_state["ubigeo_ready"]:
         df_up = cargar_tabla_ubigeo_excel_bytes(ubigeo_file.getvalue())
         if df_up is not None and not df_up.empty:
             st.session_state["ubigeo_df"] = df_up
+            st.session_state["ubigeo_index"] = indexar_ubigeo(df_up)
             st.session_state["ubigeo_ready"] = True
             st.success("✅ Ubigeo cargado desde archivo subido.")
             st.rerun()  # recarga para habilitar páginas
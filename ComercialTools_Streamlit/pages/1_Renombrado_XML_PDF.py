@@ -1,158 +1,19 @@
 import streamlit as st
-import io, zipfile, tarfile, os
-from utils.core import emparejar_y_reportar
-
-# ====================== CONFIG DE SEGURIDAD ======================
-MAX_DEPTH = 3                     # Profundidad máxima de compresión anidada
-MAX_TOTAL_BYTES = 200 * 1024**2   # 200 MB descomprimidos
-ALLOWED_ARCHIVE_EXTS = {".zip", ".tar", ".gz", ".tgz", ".7z", ".rar"}
-
-# Soportes opcionales
-try:
-    import py7zr
-    _HAS_PY7ZR = True
-except Exception:
-    _HAS_PY7ZR = False
-
-try:
-    import rarfile
-    _HAS_RAR = True
-except Exception:
-    _HAS_RAR = False
-
-
-# ====================== HELPERS ======================
-def _lower_ext(name: str) -> str:
-    n = name.lower()
-    if n.endswith(".tar.gz") or n.endswith(".tgz"):
-        return ".tgz"
-    for ext in [".xml", ".pdf", ".zip", ".tar", ".gz", ".7z", ".rar"]:
-        if n.endswith(ext):
-            return ext
-    return ""
-
-def _is_archive(name: str) -> bool:
-    return _lower_ext(name) in ALLOWED_ARCHIVE_EXTS
-
-def _safe_add(total_bytes: int, add: int) -> int:
-    new_total = total_bytes + add
-    if new_total > MAX_TOTAL_BYTES:
-        raise ValueError(
-            f"Se superó el límite total descomprimido ({MAX_TOTAL_BYTES/1024**2:.0f} MB)."
-        )
-    return new_total
-
-def _iter_zip(data: bytes):
-    with zipfile.ZipFile(io.BytesIO(data)) as zf:
-        for info in zf.infolist():
-            if info.is_dir():
-                continue
-            yield info.filename, zf.read(info)
-
-def _iter_tar_like(data: bytes):
-    with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as tf:
-        for m in tf.getmembers():
-            if not m.isfile():
-                continue
-            f = tf.extractfile(m)
-            if not f:
-                continue
-            yield m.name, f.read()
-
-def _iter_7z(data: bytes):
-    if not _HAS_PY7ZR:
-        raise RuntimeError("py7zr no está instalado. Agrega 'py7zr' a requirements.txt")
-    with py7zr.SevenZipFile(io.BytesIO(data), mode='r') as z:
-        for name, bio in z.readall().items():
-            yield name, bio.read()
-
-def _iter_rar(data: bytes):
-    if not _HAS_RAR:
-        raise RuntimeError("rarfile no está instalado. Agrega 'rarfile' a requirements.txt")
-    with rarfile.RarFile(io.BytesIO(data)) as rf:
-        for info in rf.infolist():
-            if info.is_dir():
-                continue
-            with rf.open(info) as f:
-                yield info.filename, f.read()
-
-def _dispatch_iter(name: str, data: bytes):
-    ext = _lower_ext(name)
-    if ext == ".zip":
-        return _iter_zip(data)
-    if ext in (".tar", ".gz", ".tgz"):
-        return _iter_tar_like(data)
-    if ext == ".7z":
-        return _iter_7z(data)
-    if ext == ".rar":
-        return _iter_rar(data)
-    raise ValueError(f"Extensión no soportada: {ext}")
-
-def _basename_inside(name: str) -> str:
-    """
-    Devuelve el nombre base del archivo, incluso si viene de dentro de un comprimido.
-    'outer.zip!/carpeta/archivo.xml' -> 'archivo.xml'
-    """
-    # Toma la parte después del último '!/' si existe
-    inner = name.split("!/")[-1]
-    # Luego toma solo el filename
-    return os.path.basename(inner)
-
+from utils.core import emparejar_y_reportar, construir_zip_resultado, cerrar_descarga
+from utils.archivos import MAX_DEPTH, colectar_xml_pdf, huella_adjuntos
+from utils.procesos import pool_procesos
 
 # ====================== LÓGICA DE EXTRACCIÓN ======================
 def colectar_xml_pdf_desde_adjuntos(uploads, max_depth=MAX_DEPTH):
     """
     Recorre archivos subidos (XML, PDF o comprimidos).
     Excluye únicamente los XML cuyo nombre base comience con 'R-'.
-    Devuelve (xml_files, pdf_files, skipped_r_xml_count).
+    Devuelve (xml_files, pdf_files, skipped_r_xml_count, avisos); los avisos
+    ([("warning"|"error", mensaje)]) se guardan con el resultado y se muestran en cada run.
     """
-    xml_files, pdf_files = [], []
-    skipped_r_xml = 0
-    total_bytes = 0
-    from collections import deque
-    q = deque()
-
-    for up in uploads:
-        name = up.name
-        data = up.read()
-        total_bytes = _safe_add(total_bytes, len(data))
-        q.append((name, data, 0))
-
-    while q:
-        name, data, depth = q.popleft()
-        ext = _lower_ext(name)
-        base = _basename_inside(name)
-
-        if ext == ".xml":
-            # Solo excluir XML que comiencen con 'R-'
-            if base.lower().startswith("r-"):
-                skipped_r_xml += 1
-                continue
-            xml_files.append({"filename": name, "content": data})
-            continue
-
-        if ext == ".pdf":
-            # Los PDF no se excluyen
-            pdf_files.append({"filename": name, "content": data})
-            continue
-
-        if _is_archive(name):
-            if depth >= max_depth:
-                st.warning(f"Se omitió contenido anidado en '{name}' (profundidad > {max_depth}).")
-                continue
-            try:
-                for inner_name, inner_bytes in _dispatch_iter(name, data):
-                    total_bytes = _safe_add(total_bytes, len(inner_bytes))
-                    composed = f"{name}!/{inner_name}"
-                    if _is_archive(inner_name):
-                        q.append((composed, inner_bytes, depth + 1))
-                    else:
-                        q.append((composed, inner_bytes, depth))
-            except Exception as e:
-                st.error(f"No se pudo leer el archivo comprimido '{name}': {e}")
-                continue
-
-    return xml_files, pdf_files, skipped_r_xml
+    avisos = []
+    xml_files, pdf_files, skipped_r_xml = colectar_xml_pdf(uploads, max_depth, avisos, pool_procesos())
+    return xml_files, pdf_files, skipped_r_xml, avisos
 
 
 # ====================== UI STREAMLIT ======================
@@ -166,15 +27,15 @@ if "ubigeo_ready" not in st.session_state or not st.session_state["ubigeo_ready"
         st.stop()
     st.stop()
 
-df_ubi = st.session_state["ubigeo_df"]
+ubi_idx = st.session_state["ubigeo_index"]   # (Dep, Prov, Dist) -> Ubigeo, armado en Home
 
 def limpiar_pagina():
     for k in [
-        "ren_xml_files", "ren_pdf_files",
+        "ren_xml_files", "ren_pdf_files", "ren_skipped_r", "ren_result_key",
         "ren_resultado_zip", "ren_reporte_emparejamientos",
-        "ren_reporte_errores"
+        "ren_reporte_errores", "ren_avisos"
     ]:
-        st.session_state.pop(k, None)
+        cerrar_descarga(st.session_state.pop(k, None))
     st.session_state["ren_uploader_key"] = st.session_state.get("ren_uploader_key", 0) + 1
     st.rerun()
 
@@ -192,42 +53,44 @@ files = st.file_uploader(
 )
 
 if files:
-    xml_files, pdf_files, skipped_r = colectar_xml_pdf_desde_adjuntos(files)
-
-    st.session_state["ren_xml_files"] = [x["filename"] for x in xml_files]
-    st.session_state["ren_pdf_files"] = [p["filename"] for p in pdf_files]
+    # Mismos archivos que en el run anterior (p.ej. tras clic en descargar) → reusar todo
+    result_key = huella_adjuntos(files)
+    if st.session_state.get("ren_result_key") != result_key:
+        xml_files, pdf_files, skipped_r, avisos = colectar_xml_pdf_desde_adjuntos(files)
+        resultado_ordenado, excel_report_buffer, rep_emp_txt, rep_err_txt = emparejar_y_reportar(
+            xml_files, pdf_files, ubi_idx, pool_procesos()
+        )
+        resultado_zip = construir_zip_resultado(resultado_ordenado, excel_report_buffer)
+        cerrar_descarga(st.session_state.get("ren_resultado_zip"))   # el del lote anterior
+        st.session_state.update({
+            "ren_result_key": result_key,
+            "ren_xml_files": [n for n, _ in xml_files],
+            "ren_pdf_files": [n for n, _ in pdf_files],
+            "ren_skipped_r": skipped_r,
+            "ren_avisos": avisos,
+            "ren_reporte_emparejamientos": rep_emp_txt,
+            "ren_reporte_errores": rep_err_txt,
+            "ren_resultado_zip": resultado_zip,
+        })
+
+    # Comprimidos omitidos/corruptos y cortes por profundidad o tamaño: también al reusar
+    for nivel, msg in st.session_state["ren_avisos"]:
+        getattr(st, nivel)(msg)
 
     st.success(
-        f"Detectados: XML={len(xml_files)} | PDF={len(pdf_files)}. "
-        f"Excluidos por 'R-': {skipped_r} XML."
+        f"Detectados: XML={len(st.session_state['ren_xml_files'])} | PDF={len(st.session_state['ren_pdf_files'])}. "
+        f"Excluidos por 'R-': {st.session_state['ren_skipped_r']} XML."
     )
 
-    resultado_ordenado, excel_report_buffer, rep_emp_txt, rep_err_txt = emparejar_y_reportar(
-        xml_files, pdf_files, df_ubi
-    )
-
-    st.session_state["ren_reporte_emparejamientos"] = rep_emp_txt
-    st.session_state["ren_reporte_errores"] = rep_err_txt
-
     st.subheader("🧾 reporte_emparejamientos")
-    st.code(rep_emp_txt)
+    st.code(st.session_state["ren_reporte_emparejamientos"])
 
     st.subheader("⚠ reporte_errores")
-    st.code(rep_err_txt)
-
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for name, content in resultado_ordenado:
-            # Limpia la notación de ruta de archivos anidados
-            safe_name = name.replace("!/", "__")
-            zf.writestr(safe_name, content)
-        if excel_report_buffer is not None:
-            zf.writestr("reporte_ubigeo.xlsx", excel_report_buffer.getvalue())
-    zip_buffer.seek(0)
+    st.code(st.session_state["ren_reporte_errores"])
 
     st.download_button(
         "⬇ Descargar resultado (ZIP)",
-        data=zip_buffer.getvalue(),
+        data=st.session_state["ren_resultado_zip"],
         file_name="Resultado_emparejamiento_xml_pdf_ubigeo.zip",
         mime="application/zip"
     )
@@ -6,496 +6,264 @@
 # xlsxwriter
 # py7zr            # opcional, sólo si usarás .7z
 # rarfile          # opcional, sólo si usarás .rar
-# lxml             # opcional, para XMLs pesados (aquí usamos ElementTree estándar)
+# lxml             # opcional, para XMLs pesados (si no está, se usa ElementTree estándar)
 
 import streamlit as st
-import io, os, re, math, zipfile, tarfile
+import io, os, re, tempfile
+import numpy as np
 import pandas as pd
-import xml.etree.ElementTree as ET
 from typing import Dict, List, Tuple, Optional
 
-# Tu core existente (no lo tocamos)
+# Lógica compartida con la página de renombrado (utils/core.py)
 from utils.core import (
     build_id_facturas_por_ruc,   # si lo usas en otros pasos
-    emparejar_y_reportar         # reordenamiento + reporte ubigeo
+    emparejar_y_reportar,        # reordenamiento + reporte ubigeo
+    extraer_datos_xmls,          # parseo de los XML, compartido por los dos anteriores
+    construir_zip_resultado,     # ZIP final (libdeflate)
+    archivo_para_descarga, cerrar_descarga,
+    EXCEL_ENGINE,                # calamine si está instalado
+    _nuevo_xlsx, _escribir_filas, _escribir_hoja,   # salida xlsx fila por fila
 )
+from utils.archivos import MAX_DEPTH, colectar_xml_pdf, huella_adjuntos, basename_inside, as_fileobj
+from utils.xml_meta import DOC_RE, NON_DIGIT, extraer_metas_xml
+from utils.procesos import pool_procesos
 
-# ====================== CONFIG DE SEGURIDAD ======================
-MAX_DEPTH = 3                     # Profundidad máxima para compresiones anidadas
-MAX_TOTAL_BYTES = 200 * 1024**2   # 200 MB descomprimidos
-ALLOWED_ARCHIVE_EXTS = {".zip", ".tar", ".gz", ".tgz", ".7z", ".rar"}
-
-# Soportes opcionales 7z / rar
-try:
-    import py7zr
-    _HAS_PY7ZR = True
-except Exception:
-    _HAS_PY7ZR = False
-
-try:
-    import rarfile
-    _HAS_RAR = True
-except Exception:
-    _HAS_RAR = False
-
-
-# ====================== HELPERS DE ARCHIVOS ======================
-def _lower_ext(name: str) -> str:
-    n = name.lower()
-    if n.endswith(".tar.gz") or n.endswith(".tgz"):
-        return ".tgz"
-    for ext in [".xml", ".pdf", ".zip", ".tar", ".gz", ".7z", ".rar"]:
-        if n.endswith(ext):
-            return ext
-    return ""
-
-def _is_archive(name: str) -> bool:
-    return _lower_ext(name) in ALLOWED_ARCHIVE_EXTS
-
-def _safe_add(total_bytes: int, add: int) -> int:
-    new_total = total_bytes + add
-    if new_total > MAX_TOTAL_BYTES:
-        raise ValueError(
-            f"Se superó el límite total descomprimido ({MAX_TOTAL_BYTES/1024**2:.0f} MB)."
-        )
-    return new_total
-
-def _iter_zip(data: bytes):
-    with zipfile.ZipFile(io.BytesIO(data)) as zf:
-        for info in zf.infolist():
-            if info.is_dir():
-                continue
-            yield info.filename, zf.read(info)
-
-def _iter_tar_like(data: bytes):
-    with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as tf:
-        for m in tf.getmembers():
-            if not m.isfile():
-                continue
-            f = tf.extractfile(m)
-            if not f:
-                continue
-            yield m.name, f.read()
-
-def _iter_7z(data: bytes):
-    if not _HAS_PY7ZR:
-        raise RuntimeError("py7zr no está instalado. Agrega 'py7zr' a requirements.txt")
-    with py7zr.SevenZipFile(io.BytesIO(data), mode='r') as z:
-        for name, bio in z.readall().items():
-            yield name, bio.read()
-
-def _iter_rar(data: bytes):
-    if not _HAS_RAR:
-        raise RuntimeError("rarfile no está instalado. Agrega 'rarfile' a requirements.txt")
-    with rarfile.RarFile(io.BytesIO(data)) as rf:
-        for info in rf.infolist():
-            if info.is_dir():
-                continue
-            with rf.open(info) as f:
-                yield info.filename, f.read()
-
-def _dispatch_iter(name: str, data: bytes):
-    ext = _lower_ext(name)
-    if ext == ".zip":
-        return _iter_zip(data)
-    if ext in (".tar", ".gz", ".tgz"):
-        return _iter_tar_like(data)
-    if ext == ".7z":
-        return _iter_7z(data)
-    if ext == ".rar":
-        return _iter_rar(data)
-    raise ValueError(f"Extensión no soportada: {ext}")
-
-def _basename_inside(name: str) -> str:
-    """ Devuelve el filename base aunque provenga de un comprimido: 'a.zip!/b/c.xml' -> 'c.xml' """
-    inner = name.split("!/")[-1]
-    return os.path.basename(inner)
 
+# ====================== EXTRACCIÓN DE ADJUNTOS ======================
 def colectar_xml_pdf_desde_adjuntos(uploads, max_depth=MAX_DEPTH, exclude_r_xml=True):
     """
     Recorre archivos subidos (XML, PDF o comprimidos anidados) y devuelve:
-      xml_files, pdf_files  (cada item: {filename, content})
+      xml_files, pdf_files  (cada item: (filename, archivo); leer con read_all)
+      avisos                [("warning"|"error", mensaje)]; se guardan con el resultado
+                            y se muestran en cada run
     Si exclude_r_xml=True, excluye XML cuyo nombre base empiece con 'R-'.
     """
-    xml_files, pdf_files = [], []
-    total_bytes = 0
-    from collections import deque
-    q = deque()
-
-    for up in uploads:
-        name = up.name
-        data = up.read()
-        total_bytes = _safe_add(total_bytes, len(data))
-        q.append((name, data, 0))
-
-    while q:
-        name, data, depth = q.popleft()
-        ext = _lower_ext(name)
-        base = _basename_inside(name)
-
-        if ext == ".xml":
-            if exclude_r_xml and base.lower().startswith("r-"):
-                continue
-            xml_files.append({"filename": name, "content": data})
-            continue
-
-        if ext == ".pdf":
-            pdf_files.append({"filename": name, "content": data})
-            continue
-
-        if _is_archive(name):
-            if depth >= max_depth:
-                st.warning(f"Se omitió contenido anidado en '{name}' (profundidad > {max_depth}).")
-                continue
-            try:
-                for inner_name, inner_bytes in _dispatch_iter(name, data):
-                    total_bytes = _safe_add(total_bytes, len(inner_bytes))
-                    composed = f"{name}!/{inner_name}"
-                    if _is_archive(inner_name):
-                        q.append((composed, inner_bytes, depth + 1))
-                    else:
-                        q.append((composed, inner_bytes, depth))
-            except Exception as e:
-                st.error(f"No se pudo leer el archivo comprimido '{name}': {e}")
-                continue
-
-    return xml_files, pdf_files
+    avisos = []
+    xml_files, pdf_files, _ = colectar_xml_pdf(uploads, max_depth, avisos, pool_procesos(), exclude_r_xml)
+    return xml_files, pdf_files, avisos
 
 
 # ====================== HELPERS DE NORMALIZACIÓN ======================
 RUC_REGEX = re.compile(r"(\d{11})")
+SEP_DOC_RE = re.compile(r"[/_ ]")
+# Encabezados reconocidos (en minúsculas, sin espacios en los extremos)
+RUC_COLS = frozenset({"ruc", "r.u.c", "ruc cliente", "ruc cedente", "ruc_pagador",
+                      "ruc pagador", "ruc emisor", "ruc proveedor"})
+DOC_COLS = frozenset({"documento", "doc", "documento ref", "número doc", "numero doc",
+                      "número de documento", "nro doc"})
 
-def _to_safe_str(v) -> str:
-    """Convierte a str de forma segura (soporta int/float/None/NaN)."""
-    if v is None:
-        return ""
-    if isinstance(v, float) and math.isnan(v):
-        return ""
-    s = str(v)
-    if s.lower() == "nan":
-        return ""
-    return s.strip()
-
-def _normalize_ruc(v) -> str:
+
+# ====================== ÍNDICES: XML CANÓNICO + PDFs ======================
+def build_index_from_xml_and_pdfs(xml_metas, pdf_names):
     """
-    Devuelve un RUC de 11 dígitos:
-      - Si v ya es 11 dígitos → ok
-      - Si v es numérico → lo convierte a entero-string
-      - Si v es texto → extrae la primera seq de 11 dígitos
-    Si no encuentra, retorna "".
+    Construye índice canónico a partir del CONTENIDO XML (ya parseado con
+    extraer_metas_xml: xml_metas = [(filename, meta)]) y de los nombres de PDF:
+      - xml_df: DataFrame [ruc, serie, corr, xml_name], una fila por (ruc, serie, corr)
+        (si se repite, vale el último XML), agrupadas por (serie, corr) en el orden de
+        subida ("primero" ante ambigüedad = el primero subido)
+      - pdf_df: DataFrame [pdf_name, ruc, serie, corr] de los PDFs con serie/corr en el
+        nombre (ruc "" si no trae), en el orden de subida
     """
-    s = _to_safe_str(v)
-    digits = re.sub(r"\D", "", s)
-    if len(digits) == 11:
-        return digits
-    m = RUC_REGEX.search(s)
-    return m.group(1) if m else ""
-
-def _normalize_series(v) -> Optional[str]:
-    s = _to_safe_str(v)
-    return s.upper() if s else None
-
-def _normalize_corr(v) -> Optional[str]:
-    """Devuelve correlativo sin decimales/ceros a la izquierda si es numérico."""
-    s = _to_safe_str(v)
-    if not s:
-        return None
-    try:
-        return str(int(float(s)))
-    except Exception:
-        if s.isdigit():
-            return str(int(s))
-        return s
+    # XMLs: sólo los que traen RUC, serie y correlativo
+    claves = ["ruc", "serie", "corr"]
+    xml_df = pd.DataFrame([meta for _, meta in xml_metas], columns=claves, dtype=object).fillna("")
+    xml_df["xml_name"] = [basename_inside(f) for f, _ in xml_metas]
+    xml_df = xml_df[(xml_df[claves] != "").all(axis=1)]
+    xml_df = xml_df.groupby(claves, sort=False)["xml_name"].last().reset_index()
+    grupo = xml_df.groupby(["serie", "corr"], sort=False).ngroup()
+    xml_df = xml_df.iloc[np.argsort(grupo.to_numpy(), kind="stable")].reset_index(drop=True)
 
+    # PDFs (por nombre)
+    bases = pd.Series([basename_inside(f) for f in pdf_names], dtype=object)
+    stems = pd.Series([os.path.splitext(b)[0] for b in bases], dtype=object)
+    sc = stems.str.upper().str.extract(DOC_RE)
+    pdf_df = pd.DataFrame({"pdf_name": bases, "ruc": _col_ruc(stems), "serie": sc[0], "corr": sc[1]})
+    pdf_df = pdf_df[pdf_df["serie"].notna()].reset_index(drop=True)
 
-# ====================== PARSEO DE XML (CANÓNICO) ======================
-def _safe_decode(b: bytes) -> str:
-    try:
-        return b.decode("utf-8", errors="ignore")
-    except Exception:
-        return str(b)
-
-def _extract_xml_meta(xml_bytes: bytes) -> Dict[str, Optional[str]]:
-    """
-    Devuelve dict con:
-      - ruc: RUC emisor (11 dígitos)
-      - tipo: '01'/'03'/etc. si se encuentra
-      - serie: p.ej. 'F001'
-      - corr: p.ej. '00005905' (padding exacto del XML)
-      - id_full: p.ej. 'F001-00005905'
-    Intenta UBL estándar Perú y es tolerante a namespaces.
-    """
-    meta = {"ruc": None, "tipo": None, "serie": None, "corr": None, "id_full": None}
-    text = _safe_decode(xml_bytes)
-    try:
-        it = ET.iterparse(io.BytesIO(xml_bytes))
-        for _, el in it:
-            if "}" in el.tag:
-                el.tag = el.tag.split("}", 1)[1]  # quita namespace
-        root = it.root
-
-        # ID del comprobante (cbc:ID a nivel documento)
-        id_node = root.find(".//ID")
-        if id_node is not None and id_node.text:
-            doc_id = id_node.text.strip()
-            meta["id_full"] = doc_id
-            if "-" in doc_id:
-                s, c = doc_id.split("-", 1)
-                meta["serie"] = s.strip().upper()
-                meta["corr"]  = c.strip()
-            else:
-                m = re.search(r"([A-Z]{1,3}\d{1,4})\D?(\d{1,12})", doc_id.upper())
-                if m:
-                    meta["serie"] = m.group(1)
-                    meta["corr"]  = m.group(2)
-
-        # Tipo
-        tnode = root.find(".//InvoiceTypeCode")
-        if tnode is None:
-            tnode = root.find(".//CreditNoteTypeCode")
-        if tnode is None:
-            tnode = root.find(".//DebitNoteTypeCode")
-        if tnode is not None and tnode.text:
-            meta["tipo"] = _to_safe_str(tnode.text)
-
-        # RUC emisor (schemeID="6")
-        ruc_node = None
-        for idn in root.findall(".//ID"):
-            attrs = idn.attrib or {}
-            if attrs.get("schemeID", "").strip() == "6":
-                r_digits = re.sub(r"\D", "", (idn.text or ""))
-                if len(r_digits) == 11:
-                    ruc_node = idn
-                    break
-        if ruc_node is not None and ruc_node.text:
-            meta["ruc"] = re.sub(r"\D", "", ruc_node.text.strip())
+    return xml_df, pdf_df
 
-    except Exception:
-        # fallback regex
-        m = re.search(r"<cbc:ID[^>]*>(.*?)</cbc:ID>", text, flags=re.IGNORECASE|re.DOTALL)
-        if m:
-            id_full = re.sub(r"\s+", "", m.group(1))
-            meta["id_full"] = id_full
-            mm = re.search(r"([A-Z]{1,3}\d{1,4})\D?(\d{1,12})", id_full, flags=re.IGNORECASE)
-            if mm:
-                meta["serie"] = mm.group(1).upper()
-                meta["corr"]  = mm.group(2)
-        m2 = re.search(r'schemeID\s*=\s*"6"[^>]*>\s*([0-9]{11})\s*<', text, flags=re.IGNORECASE)
-        if m2:
-            meta["ruc"] = m2.group(1)
-        m3 = re.search(r"<cbc:(?:InvoiceTypeCode|CreditNoteTypeCode|DebitNoteTypeCode)[^>]*>\s*([0-9]{2})\s*<", text, flags=re.IGNORECASE)
-        if m3:
-            meta["tipo"] = m3.group(1)
-
-    if meta["serie"]:
-        meta["serie"] = meta["serie"].upper()
-    return meta
 
+def _col_texto(col: pd.Series) -> pd.Series:
+    """Texto de cada celda sin espacios en los extremos (vacíos/NaN → "")."""
+    s = col.astype(str).where(col.notna(), "").str.strip()
+    return s.where(s.str.lower() != "nan", "")
 
-# ====================== ÍNDICES: XML CANÓNICO + PDFs ======================
-def build_index_from_xml_and_pdfs(xml_files, pdf_files):
+def _col_ruc(col: pd.Series) -> pd.Series:
     """
-    Construye índice canónico a partir del CONTENIDO XML:
-      key principal: (ruc, serie, corr)  -> { xml_name, tipo, id_full, corr_len }
-    Y además:
-      - map_by_sc: (serie, corr) -> set(ruc)
-      - pdf_by_sc: (serie, corr) -> [pdf_name, ...]
-      - pdf_by_ruc_sc: (ruc, serie, corr) -> [pdf_name, ...]
+    RUC de 11 dígitos por celda: sus dígitos si son exactamente 11, si no la
+    primera secuencia de 11 dígitos; "" si no hay RUC.
     """
-    idx = {}
-    map_by_sc = {}
-    pdf_by_sc = {}
-    pdf_by_ruc_sc = {}
-
-    # XMLs
-    for f in xml_files:
-        base = _basename_inside(f["filename"])
-        meta = _extract_xml_meta(f["content"])
-        ruc, serie, corr, tipo, id_full = meta["ruc"], meta["serie"], meta["corr"], meta["tipo"], meta["id_full"]
-        if not (ruc and serie and corr):
-            continue
-        key = (ruc, serie, corr)
-        idx[key] = {
-            "xml_name": base,
-            "tipo": tipo,
-            "id_full": id_full,
-            "corr_len": len(corr),
-        }
-        map_by_sc.setdefault((serie, corr), set()).add(ruc)
-
-    # PDFs (por nombre)
-    def parse_from_name(fname: str):
-        stem = os.path.splitext(os.path.basename(fname))[0]
-        ruc = _normalize_ruc(stem)
-        m = re.search(r"([A-Z]{1,3}\d{1,4})\D?(\d{1,12})", stem.upper())
-        serie = m.group(1) if m else None
-        corr  = m.group(2) if m else None
-        return ruc, serie, corr
-
-    for p in pdf_files:
-        basep = _basename_inside(p["filename"])
-        rucp, seriep, corrp = parse_from_name(basep)
-        if seriep and corrp:
-            pdf_by_sc.setdefault((seriep, corrp), []).append(basep)
-            if rucp:
-                pdf_by_ruc_sc.setdefault((rucp, seriep, corrp), []).append(basep)
-
-    return idx, map_by_sc, pdf_by_sc, pdf_by_ruc_sc
-
-
-# ====================== PARSEO “Documento” (Excel) ======================
-def _parse_documento_excel(v) -> Tuple[Optional[str], Optional[str]]:
+    s = _col_texto(col)
+    # La regex sólo corre sobre las celdas que no son ya puro dígito (lo común es que lo sean)
+    digits = s.copy()
+    sucio = ~s.str.isdecimal()
+    if sucio.any():
+        digits[sucio] = s[sucio].str.replace(NON_DIGIT, "", regex=True)
+    return digits.where(digits.str.len() == 11, s.str.extract(RUC_REGEX)[0]).fillna("")
+
+def _tabla_candidatos(xml_df, pdf_df) -> pd.DataFrame:
     """
-    'Documento' puede venir 'F001-5905' o 'F001-00005905'.
-    Devuelve (serie, corr_num) con:
-      - serie en upper
-      - corr_num SIN padding (solo dígitos) para re-padear según XML.
+    Índice canónico como tabla para el merge con el Excel: una fila por (ruc, serie, corr)
+    en el orden de xml_df ("orden" = prioridad ante ambigüedad), con su XML y el PDF
+    elegido (primero por RUC+serie+corr, si no por serie+corr) y cuántos había.
     """
-    s = _to_safe_str(v).upper()
-    if not s:
-        return None, None
-    s = s.replace("/", "-").replace("_", "-").replace(" ", "-")
-    m = re.search(r"([A-Z]{1,3}\d{1,4})\D?(\d{1,12})", s)
-    if not m:
-        return None, None
-    serie = m.group(1)
-    corr_raw = re.sub(r"\D", "", m.group(2))
-    corr_num = str(int(corr_raw)) if corr_raw else None
-    return serie, corr_num
+    cand = xml_df.copy()
+    cand.insert(3, "corr_num", cand["corr"].str.lstrip("0").replace("", "0"))
+
+    # PDFs: primero de cada grupo (orden de subida) y tamaño del grupo
+    por_ruc = (pdf_df[pdf_df["ruc"] != ""]
+               .groupby(["ruc", "serie", "corr"], sort=False)["pdf_name"]
+               .agg(pdf_ruc="first", n_pdf_ruc="size").reset_index())
+    por_sc = (pdf_df.groupby(["serie", "corr"], sort=False)["pdf_name"]
+              .agg(pdf_sc="first", n_pdf_sc="size").reset_index())
+    cand = (cand.merge(por_ruc, how="left", on=["ruc", "serie", "corr"])
+                .merge(por_sc, how="left", on=["serie", "corr"]))
+    cand[["n_pdf_ruc", "n_pdf_sc"]] = cand[["n_pdf_ruc", "n_pdf_sc"]].fillna(0).astype(int)
+    cand["pdf_name"] = cand["pdf_ruc"].where(cand["n_pdf_ruc"] > 0, cand["pdf_sc"]).fillna("")
+    cand["orden"] = range(len(cand))
+    return cand
+
+def indice_candidatos(xml_metas, pdf_names) -> pd.DataFrame:
+    """Índice XML+PDF listo para validar; no depende del Excel (se arma una vez por lote)."""
+    return _tabla_candidatos(*build_index_from_xml_and_pdfs(xml_metas, pdf_names))
 
 
 # ====================== VALIDACIÓN PRINCIPAL (XML→EXCEL) ======================
+COLS_ERR = ("Hoja", "Fila", "Motivo", "Detalle")   # reporte de observaciones
+
 def validar_confirming_nombres_desde_xml_excel(
-    excel_bytes: bytes,
-    xml_files: List[Dict],
-    pdf_files: List[Dict],
-) -> Tuple[io.BytesIO, io.BytesIO, str]:
+    excel_src,
+    xml_metas: List[Tuple[str, Dict[str, Optional[str]]]],
+    pdf_names: List[str],
+    cand_df: Optional[pd.DataFrame] = None,
+) -> Tuple[io.BufferedReader, io.BufferedReader, str]:
     """
     Flujo:
-      1) Lee XML y construye índice canónico (RUC, SERIE, CORR) desde contenido del XML.
+      1) Construye índice canónico (RUC, SERIE, CORR) desde los metadatos del contenido XML.
       2) Asocia PDFs por nombre (si coinciden SERIE/CORR y opcionalmente RUC).
+         Si ya se tiene la tabla de candidatos (índice_candidatos) se pasa en cand_df
+         y se omiten 1) y 2).
       3) Lee Excel: por cada fila, toma 'Documento' (aunque venga sin padding),
          intenta match con índice canónico. Si Excel trae RUC, lo usa para desambiguar.
       4) Escribe: Nombre_XML, Nombre_PDF, Nombre Verificado (SERIE-CORR canon).
     """
-    idx, map_by_sc, pdf_by_sc, pdf_by_ruc_sc = build_index_from_xml_and_pdfs(xml_files, pdf_files)
-    xls = pd.ExcelFile(io.BytesIO(excel_bytes))
-    sheets_out = {}
-    errores_rows = []
+    if cand_df is None:
+        cand_df = indice_candidatos(xml_metas, pdf_names)
+    # calamine si está instalado (si no, openpyxl en modo read_only): las hojas se leen
+    # de a una, y cada hoja validada se vuelca de inmediato a la salida; nunca hay dos en memoria.
+    xls = pd.ExcelFile(as_fileobj(excel_src), engine=EXCEL_ENGINE)   # bytes o el UploadedFile tal cual
+    validado_tmp = tempfile.TemporaryFile(suffix=".xlsx")   # salidas a disco, no en RAM
+    wb_out, fmt_out = _nuevo_xlsx(validado_tmp)
+    n_hojas = 0
+    errores_rows = []   # tuplas (Hoja, Fila, Motivo, Detalle)
 
     for sh in xls.sheet_names:
         df = xls.parse(sh)
+        n_hojas += 1
 
         # Crear columnas de salida si no existen
         if "Nombre_XML" not in df.columns: df["Nombre_XML"] = ""
         if "Nombre_PDF" not in df.columns: df["Nombre_PDF"] = ""
         if "Nombre Verificado" not in df.columns: df["Nombre Verificado"] = ""
 
+        # Encabezados normalizados una vez por hoja; gana la primera columna que coincida
+        encabezados = [(str(c).strip().lower(), c) for c in df.columns]
         # RUC (opcional para desambiguar)
-        ruc_col = None
-        for c in df.columns:
-            if str(c).strip().lower() in (
-                "ruc", "r.u.c", "ruc cliente", "ruc cedente", "ruc_pagador",
-                "ruc pagador", "ruc emisor", "ruc proveedor"
-            ):
-                ruc_col = c
-                break
-
+        ruc_col = next((c for k, c in encabezados if k in RUC_COLS), None)
         # Documento (obligatorio en este flujo)
-        doc_col = next(
-            (c for c in df.columns if str(c).strip().lower() in
-             ("documento", "doc", "documento ref", "número doc", "numero doc", "número de documento", "nro doc")),
-            None
-        )
+        doc_col = next((c for k, c in encabezados if k in DOC_COLS), None)
         if doc_col is None:
-            errores_rows.append({"Hoja": sh, "Fila": "-", "Motivo": "SIN_COLUMNA_DOCUMENTO", "Detalle": "No se encontró columna 'Documento'."})
-            sheets_out[sh] = df
+            errores_rows.append((sh, "-", "SIN_COLUMNA_DOCUMENTO", "No se encontró columna 'Documento'."))
+            _escribir_hoja(wb_out, fmt_out, sh, df)
             continue
 
-        for i, row in df.iterrows():
-            doc_val = row.get(doc_col)
-            serie_x, corr_num_x = _parse_documento_excel(doc_val)
-            ruc_x = _normalize_ruc(row.get(ruc_col)) if ruc_col else ""
-
-            if not (serie_x and corr_num_x):
-                errores_rows.append({"Hoja": sh, "Fila": i+2, "Motivo": "DOC_NO_PARSABLE", "Detalle": f"Documento='{doc_val}'"})
-                continue
-
-            # Buscar candidatos en el índice por (serie, corr) igualando corr sin ceros
-            candidatos_keys = []
-            for (serie_c, corr_c), rucs in map_by_sc.items():
-                if serie_c != serie_x:
-                    continue
-                if re.sub(r"^0+", "", corr_c) == corr_num_x:
-                    for ruc_c in rucs:
-                        key = (ruc_c, serie_c, corr_c)
-                        if key in idx:
-                            candidatos_keys.append(key)
-
-            if not candidatos_keys:
-                errores_rows.append({"Hoja": sh, "Fila": i+2, "Motivo": "SIN_MATCH_XML", "Detalle": f"Documento={doc_val}, Serie={serie_x}, Corr={corr_num_x}"})
-                continue
-
-            # Desambiguar por RUC si viene en Excel
-            elegido_key = None
-            if ruc_x:
-                for k in candidatos_keys:
-                    if k[0] == ruc_x:
-                        elegido_key = k
-                        break
-            if elegido_key is None:
-                elegido_key = candidatos_keys[0]
-                if len(candidatos_keys) > 1:
-                    errores_rows.append({"Hoja": sh, "Fila": i+2, "Motivo": "XML_AMBIGUO", "Detalle": f"{len(candidatos_keys)} candidatos; se tomó el primero."})
-
-            ruc_ok, serie_ok, corr_ok = elegido_key
-            meta_ok = idx[elegido_key]
-
-            # Set columnas
-            df.at[i, "Nombre_XML"] = meta_ok["xml_name"]
-            df.at[i, "Nombre Verificado"] = f"{serie_ok}-{corr_ok}"  # padding según XML
-
-            # PDF por (ruc, serie, corr) o por (serie, corr)
-            pdf_name = ""
-            pdf_cands_ruc = pdf_by_ruc_sc.get((ruc_ok, serie_ok, corr_ok), [])
-            if pdf_cands_ruc:
-                pdf_name = pdf_cands_ruc[0]
-                if len(pdf_cands_ruc) > 1:
-                    errores_rows.append({"Hoja": sh, "Fila": i+2, "Motivo": "PDF_AMBIGUO_RUC", "Detalle": f"{len(pdf_cands_ruc)} candidatos; se tomó el primero."})
-            else:
-                pdf_cands = pdf_by_sc.get((serie_ok, corr_ok), [])
-                if pdf_cands:
-                    pdf_name = pdf_cands[0]
-                    if len(pdf_cands) > 1:
-                        errores_rows.append({"Hoja": sh, "Fila": i+2, "Motivo": "PDF_AMBIGUO_SC", "Detalle": f"{len(pdf_cands)} candidatos; se tomó el primero."})
-                else:
-                    errores_rows.append({"Hoja": sh, "Fila": i+2, "Motivo": "PDF_SIN_MATCH", "Detalle": f"RUC={ruc_ok}, Serie={serie_ok}, Corr={corr_ok}"})
-
-            df.at[i, "Nombre_PDF"] = pdf_name
-
-        sheets_out[sh] = df
+        n = len(df)
+        fila = df.index.to_numpy() + 2
+        doc_raw = df[doc_col].to_numpy()
+        errs = []
+
+        def _err(pos, motivo, detalles, orden=0):
+            errs.append(pd.DataFrame({
+                "Hoja": sh, "Fila": fila[pos], "Motivo": motivo, "Detalle": list(detalles),
+                "_pos": pos, "_orden": orden,
+            }))
+
+        # Documento → (serie, corr sin ceros), sobre la columna completa
+        parsed = (_col_texto(df[doc_col]).str.upper()
+                  .str.replace(SEP_DOC_RE, "-", regex=True)
+                  .str.extract(DOC_RE))
+        parsed.columns = ["serie_x", "corr_num_x"]
+        parsed.index = pd.RangeIndex(n, name="pos")
+        parsed["corr_num_x"] = parsed["corr_num_x"].str.lstrip("0").replace("", "0")
+        parsed["ruc_x"] = _col_ruc(df[ruc_col]).to_numpy() if ruc_col else ""
+        ok = parsed["serie_x"].notna().to_numpy()
+
+        pos = np.flatnonzero(~ok)
+        _err(pos, "DOC_NO_PARSABLE", (f"Documento='{doc_raw[p]}'" for p in pos))
+
+        # Candidatos en el índice por (serie, corr sin ceros); se prefiere el del RUC del Excel
+        join = parsed[ok].reset_index().merge(
+            cand_df, how="inner", left_on=["serie_x", "corr_num_x"], right_on=["serie", "corr_num"])
+        join["ruc_ok"] = join["ruc"] == join["ruc_x"]
+        g = join.groupby("pos")
+        elegido = (join.sort_values(["pos", "ruc_ok", "orden"], ascending=[True, False, True], kind="stable")
+                       .drop_duplicates("pos").set_index("pos"))
+        elegido["n_cand"] = g.size()
+        elegido["con_ruc"] = g["ruc_ok"].any()
+
+        pos = np.flatnonzero(ok & ~np.isin(np.arange(n), elegido.index))
+        serie_x, corr_x = parsed["serie_x"].to_numpy(), parsed["corr_num_x"].to_numpy()
+        _err(pos, "SIN_MATCH_XML",
+             (f"Documento={doc_raw[p]}, Serie={serie_x[p]}, Corr={corr_x[p]}" for p in pos))
+
+        e = elegido[(elegido["n_cand"] > 1) & ~elegido["con_ruc"]]
+        _err(e.index.to_numpy(), "XML_AMBIGUO", (f"{k} candidatos; se tomó el primero." for k in e["n_cand"]), 1)
+
+        # PDF por (ruc, serie, corr) o por (serie, corr)
+        e = elegido[elegido["n_pdf_ruc"] > 1]
+        _err(e.index.to_numpy(), "PDF_AMBIGUO_RUC", (f"{k} candidatos; se tomó el primero." for k in e["n_pdf_ruc"]), 2)
+        e = elegido[(elegido["n_pdf_ruc"] == 0) & (elegido["n_pdf_sc"] > 1)]
+        _err(e.index.to_numpy(), "PDF_AMBIGUO_SC", (f"{k} candidatos; se tomó el primero." for k in e["n_pdf_sc"]), 2)
+        e = elegido[(elegido["n_pdf_ruc"] == 0) & (elegido["n_pdf_sc"] == 0)]
+        _err(e.index.to_numpy(), "PDF_SIN_MATCH",
+             (f"RUC={r}, Serie={s_}, Corr={c}" for r, s_, c in zip(e["ruc"], e["serie"], e["corr"])), 2)
+
+        # Set columnas: se arma cada columna completa y se asigna una vez
+        # (las filas sin match conservan lo que ya traía el Excel)
+        pos = elegido.index.to_numpy()
+        for col, valores in (
+            ("Nombre_XML", elegido["xml_name"]),
+            ("Nombre Verificado", elegido["serie"] + "-" + elegido["corr"]),   # padding según XML
+            ("Nombre_PDF", elegido["pdf_name"]),
+        ):
+            salida = df[col].to_numpy(dtype=object, copy=True)
+            salida[pos] = valores.to_numpy()
+            df[col] = salida
+
+        errs = pd.concat(errs).sort_values(["_pos", "_orden"], kind="stable")
+        errores_rows.extend(errs[list(COLS_ERR)].itertuples(index=False, name=None))
+        _escribir_hoja(wb_out, fmt_out, sh, df)
 
     # --- Salidas
-    validado_buffer = io.BytesIO()
-    with pd.ExcelWriter(validado_buffer, engine="xlsxwriter") as writer:
-        for sh, df in sheets_out.items():
-            df.to_excel(writer, sheet_name=sh[:31], index=False)
-    validado_buffer.seek(0)
-
-    errores_df = pd.DataFrame(errores_rows) if errores_rows else pd.DataFrame(
-        [{"Hoja": "-", "Fila": "-", "Motivo": "OK", "Detalle": "Sin observaciones"}]
-    )
-    errores_buffer = io.BytesIO()
-    with pd.ExcelWriter(errores_buffer, engine="xlsxwriter") as writer:
-        errores_df.to_excel(writer, sheet_name="Errores", index=False)
-    errores_buffer.seek(0)
+    xls.close()
+    wb_out.close()
+    with validado_tmp:
+        validado_buffer = archivo_para_descarga(validado_tmp)
+
+    # Reporte de observaciones: directo desde las tuplas, sin DataFrame
+    filas_err = errores_rows or [("-", "-", "OK", "Sin observaciones")]
+    with tempfile.TemporaryFile(suffix=".xlsx") as errores_tmp:
+        wb_err, fmt_err = _nuevo_xlsx(errores_tmp)
+        _escribir_filas(wb_err, fmt_err, "Errores", COLS_ERR, filas_err)
+        wb_err.close()
+        errores_buffer = archivo_para_descarga(errores_tmp)
 
     resumen = (
         "VALIDACIÓN DESDE XML → EXCEL\n"
         "- Fuente canónica: SERIE/CORR/RUC desde contenido del XML (no por nombre).\n"
         "- Matching Excel: se toma 'Documento', se normaliza (tolerante a ceros), y se usa RUC si existe.\n"
         "- Salida: Nombre_XML, Nombre_PDF, Nombre Verificado (SERIE-CORR con padding real del XML).\n"
-        f"- Hojas procesadas: {len(sheets_out)}\n"
+        f"- Hojas procesadas: {n_hojas}\n"
         f"- Observaciones: {len(errores_rows)}\n"
     )
     return validado_buffer, errores_buffer, resumen
@@ -513,16 +281,17 @@ if "ubigeo_ready" not in st.session_state or not st.session_state["ubigeo_ready"
         st.stop()
     st.stop()
 
-df_ubi = st.session_state["ubigeo_df"]
+ubi_idx = st.session_state["ubigeo_index"]   # (Dep, Prov, Dist) -> Ubigeo, armado en Home
 
 # --- Reset helper ---
 def limpiar_pagina():
     for k in [
         "val_xml_files", "val_pdf_files", "val_id_idx",
-        "val_rep_emp", "val_rep_err",
+        "val_rep_emp", "val_rep_err", "val_avisos",
+        "val_adjuntos", "val_index", "val_resultado_zip", "val_result_key", "val_excel_result_key",
         "val_validado_buffer", "val_errores_buffer", "val_errores_txt"
     ]:
-        st.session_state.pop(k, None)
+        cerrar_descarga(st.session_state.pop(k, None))
     st.session_state["val_uploader_files_key"] = st.session_state.get("val_uploader_files_key", 0) + 1
     st.session_state["val_uploader_excel_key"] = st.session_state.get("val_uploader_excel_key", 0) + 1
     st.rerun()
@@ -546,33 +315,65 @@ files = st.file_uploader(
 )
 
 if files:
-    # 1) Extrae y clasifica (incluye anidados, excluye XML con prefijo R-)
-    xml_files, pdf_files = colectar_xml_pdf_desde_adjuntos(files, exclude_r_xml=True)
-
-    st.session_state["val_xml_files"] = [x["filename"] for x in xml_files]
-    st.session_state["val_pdf_files"] = [p["filename"] for p in pdf_files]
+    # Mismos archivos que en el run anterior (p.ej. tras subir el Excel o descargar) → reusar
+    result_key = huella_adjuntos(files)
+    if st.session_state.get("val_result_key") != result_key:
+        # 1) Extrae y clasifica (incluye anidados, excluye XML con prefijo R-)
+        xml_files, pdf_files, avisos = colectar_xml_pdf_desde_adjuntos(files, exclude_r_xml=True)
+
+        # 2) Reordenamiento/renombrado (utils/core.py); los XML se parsean
+        #    una sola vez y el resultado sirve también para el paso 3
+        datos_xml = extraer_datos_xmls(xml_files, pool_procesos())
+        resultado_ordenado, excel_report_buffer, rep_emp_txt, rep_err_txt = emparejar_y_reportar(
+            xml_files, pdf_files, ubi_idx, pool_procesos(), datos=datos_xml
+        )
 
-    st.success(f"Detectados: XML={len(xml_files)} | PDF={len(pdf_files)} "
+        # 3) Índice opcional por RUC desde XML (si lo requieres en otros pasos)
+        try:
+            id_facturas_por_ruc = build_id_facturas_por_ruc(xml_files, datos=datos_xml)
+        except Exception:
+            id_facturas_por_ruc = None
+
+        # 4) Metadatos XML para el Paso 2 (en paralelo si el lote lo amerita): la sesión
+        #    guarda sólo nombres + metadatos, no el contenido de los archivos
+        xml_metas = list(zip(
+            [n for n, _ in xml_files],
+            extraer_metas_xml([c for _, c in xml_files], pool_procesos()),
+        ))
+
+        # ZIP final (archivos reordenados + reporte ubigeo); no depende del Excel
+        resultado_zip = construir_zip_resultado(resultado_ordenado, excel_report_buffer)
+        # Los archivos del lote anterior (ZIP y validación de su Excel) ya no se descargan
+        for k in ("val_resultado_zip", "val_validado_buffer", "val_errores_buffer"):
+            cerrar_descarga(st.session_state.pop(k, None))
+        st.session_state.update({
+            "val_result_key": result_key,
+            "val_avisos": avisos,
+            "val_adjuntos": (xml_metas, [n for n, _ in pdf_files]),
+            # Índice para el Paso 2: se reutiliza con cada Excel que se suba
+            "val_index": indice_candidatos(xml_metas, [n for n, _ in pdf_files]),
+            "val_xml_files": [n for n, _ in xml_files],
+            "val_pdf_files": [n for n, _ in pdf_files],
+            "val_rep_emp": rep_emp_txt,
+            "val_rep_err": rep_err_txt,
+            "val_id_idx": id_facturas_por_ruc,
+            "val_resultado_zip": resultado_zip,
+            "val_excel_result_key": None,
+        })
+
+    xml_metas, pdf_names = st.session_state["val_adjuntos"]
+
+    # Comprimidos omitidos/corruptos y cortes por profundidad o tamaño: también al reusar
+    for nivel, msg in st.session_state["val_avisos"]:
+        getattr(st, nivel)(msg)
+
+    st.success(f"Detectados: XML={len(xml_metas)} | PDF={len(pdf_names)} "
                f"(incluye contenido en comprimidos; XML 'R-*' excluidos)")
 
-    # 2) Reordenamiento/renombrado (usa tu core existente)
-    resultado_ordenado, excel_report_buffer, rep_emp_txt, rep_err_txt = emparejar_y_reportar(
-        xml_files, pdf_files, df_ubi
-    )
-    st.session_state["val_rep_emp"] = rep_emp_txt
-    st.session_state["val_rep_err"] = rep_err_txt
-
     st.subheader("🧾 reporte_emparejamientos.txt")
-    st.code(rep_emp_txt or "(sin contenido)")
+    st.code(st.session_state["val_rep_emp"] or "(sin contenido)")
     st.subheader("⚠ reporte_errores.txt")
-    st.code(rep_err_txt or "(sin contenido)")
-
-    # 3) Índice opcional por RUC desde XML (si lo requieres en otros pasos)
-    try:
-        id_facturas_por_ruc = build_id_facturas_por_ruc(xml_files)
-        st.session_state["val_id_idx"] = id_facturas_por_ruc
-    except Exception:
-        pass
+    st.code(st.session_state["val_rep_err"] or "(sin contenido)")
 
     st.markdown("---")
     st.subheader("Paso 2 – Sube Excel de Confirming")
@@ -586,44 +387,47 @@ if files:
     )
 
     if excel_file:
-        # 4) VALIDACIÓN: desde XML (canónico) → Excel
-        validado_buffer, errores_buffer, errores_txt = validar_confirming_nombres_desde_xml_excel(
-            excel_file.read(),
-            xml_files=xml_files,
-            pdf_files=pdf_files,
-        )
-        st.session_state["val_validado_buffer"] = validado_buffer
-        st.session_state["val_errores_buffer"] = errores_buffer
-        st.session_state["val_errores_txt"] = errores_txt
+        # 5) VALIDACIÓN: desde XML (canónico) → Excel; se repite sólo si cambió el Excel
+        excel_result_key = huella_adjuntos([excel_file])
+        if st.session_state.get("val_excel_result_key") != excel_result_key:
+            validado_buffer, errores_buffer, errores_txt = validar_confirming_nombres_desde_xml_excel(
+                excel_file,
+                xml_metas=xml_metas,
+                pdf_names=pdf_names,
+                cand_df=st.session_state["val_index"],
+            )
+            cerrar_descarga(st.session_state.get("val_validado_buffer"))   # los del Excel anterior
+            cerrar_descarga(st.session_state.get("val_errores_buffer"))
+            st.session_state.update({
+                "val_excel_result_key": excel_result_key,
+                "val_validado_buffer": validado_buffer,
+                "val_errores_buffer": errores_buffer,
+                "val_errores_txt": errores_txt,
+            })
+        validado_buffer = st.session_state["val_validado_buffer"]
+        errores_buffer = st.session_state["val_errores_buffer"]
+        errores_txt = st.session_state["val_errores_txt"]
 
         st.subheader("❗ Resumen de validación")
         st.code(errores_txt)
 
         st.download_button(
             "Descargar Plantilla VALIDADA (Nombre_XML / Nombre_PDF / Nombre Verificado)",
-            data=validado_buffer.getvalue(),
+            data=validado_buffer,
             file_name="Plantilla_Validada_Confirming.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
         st.download_button(
             "Descargar Reporte de Observaciones",
-            data=errores_buffer.getvalue(),
+            data=errores_buffer,
             file_name="Reporte_Observaciones_Confirming.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
 
         # ZIP final (archivos reordenados + reporte ubigeo)
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for name, content in resultado_ordenado:
-                safe_name = name.replace("!/", "__")  # limpia rutas anidadas
-                zf.writestr(safe_name, content)
-            if excel_report_buffer is not None:
-                zf.writestr("reporte_ubigeo.xlsx", excel_report_buffer.getvalue())
-        zip_buffer.seek(0)
         st.download_button(
             "Descargar ZIP (ORDENADO + ubigeo)",
-            data=zip_buffer.getvalue(),
+            data=st.session_state["val_resultado_zip"],
             file_name="Resultado_emparejamiento_xml_pdf_ubigeo_confirming.zip",
             mime="application/zip"
         )
@@ -0,0 +1,141 @@
+"""
+Recorrido de adjuntos (utils.archivos).
+Correr desde ComercialTools_Streamlit: python -m pytest tests
+"""
+import gzip
+import io
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import pytest
+
+from utils import archivos
+
+
+class _Subido(io.BytesIO):
+    """Lo mínimo de un UploadedFile de Streamlit: name, size, getvalue/read/seek."""
+
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+
+
+def _zip(miembros):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for nombre, data in miembros.items():
+            zf.writestr(nombre, data)
+    return buf.getvalue()
+
+
+def _tar(miembros):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tf:
+        for nombre, data in miembros.items():
+            info = tarfile.TarInfo(nombre)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _recorrer(uploads, max_depth=archivos.MAX_DEPTH, executor=None):
+    avisos = []
+    hojas = {n: archivos.read_all(f)
+             for n, f in archivos.iterar_adjuntos(uploads, max_depth, avisos, executor)}
+    return hojas, avisos
+
+
+def _xml_con_ustar_en_257():
+    """UBL válido donde "ajustar" deja "ustar" justo en el byte 257."""
+    inicio = (b'<?xml version="1.0" encoding="UTF-8"?>'
+              b'<Invoice xmlns:cbc="urn:cbc"><cbc:ID>F001-1</cbc:ID><cbc:Note>')
+    relleno = b"x" * (257 - len(inicio) - 2)
+    xml = inicio + relleno + b"ajustar saldo</cbc:Note></Invoice>"
+    assert xml[257:262] == b"ustar"
+    return xml
+
+
+def test_xml_con_ustar_en_257_no_es_tar():
+    xml = _xml_con_ustar_en_257()
+    assert archivos._tipo_comprimido("f.xml", xml) == ""
+    assert archivos._sniff(xml) == ""
+
+    hojas, avisos = _recorrer([_Subido("f.xml", xml), _Subido("lote.zip", _zip({"f.xml": xml}))])
+    assert hojas == {"f.xml": xml, "lote.zip!/f.xml": xml}
+    assert avisos == []
+
+
+def test_tar_sin_extension_se_detecta_por_firma():
+    tar = _tar({"a.xml": b"<a/>"})
+    assert archivos._tipo_comprimido("adjunto", tar) == ".tar"
+
+
+def test_comprimidos_anidados_y_limite_de_profundidad():
+    tgz = gzip.compress(_tar({"b.xml": b"<b/>", "c.zip": _zip({"c.xml": b"<c/>"})}))
+    lote = _zip({"a.xml": b"<a/>", "doc.pdf": b"%PDF-1.4", "notas.txt": b"x", "in.tgz": tgz})
+
+    hojas, avisos = _recorrer([_Subido("lote.zip", lote)])
+    assert hojas == {
+        "lote.zip!/a.xml": b"<a/>",
+        "lote.zip!/doc.pdf": b"%PDF-1.4",
+        "lote.zip!/in.tgz!/b.xml": b"<b/>",
+        "lote.zip!/in.tgz!/c.zip!/c.xml": b"<c/>",
+    }
+    assert avisos == []
+
+    # Con profundidad 2 el .zip dentro del .tgz ya no se abre
+    hojas, avisos = _recorrer([_Subido("lote.zip", lote)], max_depth=2)
+    assert "lote.zip!/in.tgz!/c.zip!/c.xml" not in hojas
+    assert "lote.zip!/in.tgz!/b.xml" in hojas
+    assert [nivel for nivel, _ in avisos] == ["warning"]
+    assert "profundidad" in avisos[0][1]
+
+
+def test_limite_total_descomprimido(monkeypatch):
+    monkeypatch.setattr(archivos, "MAX_TOTAL_BYTES", 50_000)
+    lote = _zip({f"{i}.xml": b"a" * 10_000 for i in range(8)})
+
+    hojas, avisos = _recorrer([_Subido("lote.zip", lote)])
+    assert len(hojas) < 8
+    assert [nivel for nivel, _ in avisos] == ["error"]
+    assert "límite total descomprimido" in avisos[0][1]
+
+
+# executor=None (nullcontext): iterar_adjuntos crea su propio pool de procesos
+@pytest.mark.parametrize("en_hilos", [True, False], ids=["executor", "pool_propio"])
+def test_varios_comprimidos_reparten_el_presupuesto(monkeypatch, en_hilos):
+    # 3 comprimidos: cada uno tiene un tercio del presupuesto; "grande" no cabe en el suyo
+    # y se vuelve a extraer al final, en este proceso, con lo que queda
+    monkeypatch.setattr(archivos, "MAX_TOTAL_BYTES", 100_000)
+    subidos = [
+        _Subido("chico1.zip", _zip({"a.xml": b"a" * 5_000})),
+        _Subido("grande.zip", _zip({f"{i}.xml": b"g" * 10_000 for i in range(5)})),
+        _Subido("chico2.tar", _tar({"c.xml": b"c" * 5_000})),
+    ]
+    with ThreadPoolExecutor(2) if en_hilos else nullcontext() as ex:
+        hojas, avisos = _recorrer(subidos, executor=ex)
+    assert avisos == []
+    assert list(hojas) == ["chico1.zip!/a.xml", "chico2.tar!/c.xml"] + [f"grande.zip!/{i}.xml" for i in range(5)]
+
+    # Si tampoco cabe en lo que queda, el error es el mismo que con un solo comprimido
+    subidos.append(_Subido("otro.zip", _zip({f"{i}.xml": b"o" * 10_000 for i in range(5)})))
+    with ThreadPoolExecutor(2) if en_hilos else nullcontext() as ex:
+        hojas, avisos = _recorrer(subidos, executor=ex)
+    assert [nivel for nivel, _ in avisos] == ["error"]
+    assert "límite total descomprimido" in avisos[0][1]
+
+
+def test_colectar_excluye_xml_r():
+    lote = _zip({"F001-1.xml": b"<a/>", "carpeta/R-20100000001-01.xml": b"<r/>", "R-doc.pdf": b"%PDF"})
+    subidos = [_Subido("lote.zip", lote), _Subido("r-suelto.xml", b"<r/>")]
+
+    xml_files, pdf_files, omitidos = archivos.colectar_xml_pdf(subidos)
+    assert [n for n, _ in xml_files] == ["lote.zip!/F001-1.xml"]
+    assert [n for n, _ in pdf_files] == ["lote.zip!/R-doc.pdf"]
+    assert omitidos == 2
+
+    xml_files, _, omitidos = archivos.colectar_xml_pdf(subidos, excluir_r=False)
+    assert len(xml_files) == 3 and omitidos == 0
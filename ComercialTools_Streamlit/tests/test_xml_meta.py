@@ -0,0 +1,51 @@
+"""
+Vía rápida (_meta_rapida) frente al recorrido con parser.
+Correr desde ComercialTools_Streamlit: python -m pytest tests
+"""
+import pytest
+
+from utils import xml_meta
+
+_NS = b'<Invoice xmlns:cbc="urn:cbc" xmlns:cac="urn:cac">'
+
+_CABECERA = b'<cbc:ID>F001-1</cbc:ID><cbc:InvoiceTypeCode>01</cbc:InvoiceTypeCode>'
+_RUC_REAL = b'<cac:P><cbc:ID schemeID="6">20100000001</cbc:ID></cac:P></Invoice>'
+_RUC_FALSO = b'<cbc:ID schemeID="6">20999999999</cbc:ID>'
+
+# Casos que la vía rápida no debe resolver: tiene que ceder al parser
+_CEDEN_AL_PARSER = {
+    # El RUC falso queda dentro de un comentario / CDATA / PI que cierra después del real
+    "comentario": _NS + _CABECERA + b"<!-- emisor anterior: " + _RUC_FALSO + b" -->" + _RUC_REAL,
+    "cdata": _NS + _CABECERA + b"<cbc:Note><![CDATA[ " + _RUC_FALSO + b" ]]></cbc:Note>" + _RUC_REAL,
+    "pi": _NS + _CABECERA + b"<?nota " + _RUC_FALSO + b" ?>" + _RUC_REAL,
+    # Entidades: las expande el parser, no las regex
+    "doctype": (b'<!DOCTYPE Invoice [<!ENTITY ruc "20100000001">]>' + _NS + _CABECERA
+                + b'<cac:P><cbc:ID schemeID="6">&ruc;</cbc:ID></cac:P></Invoice>'),
+    "referencia": (_NS + _CABECERA
+                   + b'<cac:P><cbc:ID schemeID="6">&#50;0100000001</cbc:ID></cac:P></Invoice>'),
+}
+
+
+@pytest.mark.parametrize("xml_bytes", _CEDEN_AL_PARSER.values(), ids=_CEDEN_AL_PARSER.keys())
+def test_via_rapida_cede_al_parser(xml_bytes):
+    assert xml_meta._meta_rapida(xml_bytes) is None
+    meta = xml_meta._extract_xml_meta(xml_bytes)
+    assert meta["ruc"] == "20100000001"
+    assert (meta["serie"], meta["corr"], meta["tipo"]) == ("F001", "1", "01")
+
+
+def test_sin_ruc_no_hay_via_rapida():
+    xml_bytes = _NS + _CABECERA + b"</Invoice>"
+    assert xml_meta._meta_rapida(xml_bytes) is None
+    meta = xml_meta._extract_xml_meta(xml_bytes)
+    assert meta["ruc"] is None
+    assert (meta["serie"], meta["corr"], meta["tipo"]) == ("F001", "1", "01")
+
+
+def test_comentario_dentro_del_id_no_corta_el_texto():
+    xml_bytes = (
+        _NS + b'<cbc:ID>F001<!--x-->-1</cbc:ID><cbc:InvoiceTypeCode>01</cbc:InvoiceTypeCode>'
+        b'<cac:P><cbc:ID schemeID="6">20100000001</cbc:ID></cac:P></Invoice>'
+    )
+    meta = xml_meta._extract_xml_meta(xml_bytes)
+    assert (meta["id_full"], meta["serie"], meta["corr"]) == ("F001-1", "F001", "1")
@@ -0,0 +1,56 @@
+"""
+ZIP final (utils.core.LibdeflateZipWriter / construir_zip_resultado) leído con zipfile.
+Correr desde ComercialTools_Streamlit: python -m pytest tests
+"""
+import io
+import random
+import zipfile
+
+import pytest
+
+from utils import core
+
+
+def _entradas():
+    return [
+        ("ORDENADO/lote.zip!/F001-1.xml", b"<Invoice>" + b"<cbc:Note>texto</cbc:Note>" * 200 + b"</Invoice>"),
+        ("ORDENADO/F001-1.pdf", b"%PDF-1.7\n" + b"0" * 5000),
+        ("ORDENADO/sin_extension", b"%PDF-1.4\n" + b"1" * 3000),   # PDF por firma
+        ("ORDENADO/aleatorio.xml", random.Random(0).randbytes(4096)),   # DEFLATE no lo achica
+        ("ORDENADO/vacio.xml", b""),
+    ]
+
+
+def test_zip_resultado_se_lee_con_zipfile():
+    reporte = io.BytesIO(b"PK\003\004" + b"xlsx" * 1000)
+    with core.construir_zip_resultado(_entradas(), reporte) as f:
+        data = f.read()
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.testzip() is None
+        esperado = {n.replace("!/", "__"): c for n, c in _entradas()}
+        esperado["reporte_ubigeo.xlsx"] = reporte.getvalue()
+        assert zf.namelist() == list(esperado)
+        for nombre, contenido in esperado.items():
+            assert zf.read(nombre) == contenido
+        metodos = {i.filename: i.compress_type for i in zf.infolist()}
+
+    assert metodos["ORDENADO/lote.zip__F001-1.xml"] == zipfile.ZIP_DEFLATED
+    for nombre in ("ORDENADO/F001-1.pdf", "ORDENADO/sin_extension",
+                   "ORDENADO/aleatorio.xml", "reporte_ubigeo.xlsx"):
+        assert metodos[nombre] == zipfile.ZIP_STORED
+
+
+def test_entrada_que_necesita_zip64_falla_con_mensaje():
+    with pytest.raises(ValueError, match="ZIP64"):
+        with core.LibdeflateZipWriter(io.BytesIO()) as zf:
+            zf.write_compressed("grande.xml", zipfile.ZIP_DEFLATED, 0, b"", 2**32)
+
+
+def test_demasiadas_entradas_falla_con_mensaje(monkeypatch):
+    monkeypatch.setattr(core, "_ZIP32_MAX_ENTRADAS", 2)
+    zf = core.LibdeflateZipWriter(io.BytesIO())
+    for i in range(3):
+        zf.writestr(f"{i}.xml", b"<a/>")
+    with pytest.raises(ValueError, match="ZIP64"):
+        zf.close()
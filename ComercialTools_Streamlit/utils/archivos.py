@@ -0,0 +1,533 @@
+"""
+Lectura de adjuntos comprimidos (zip/tar/tgz/gz/7z/rar, anidados).
+Compartido por las páginas; sin dependencias de Streamlit para poder
+ejecutarse en procesos hijos (ProcessPoolExecutor).
+"""
+import gzip, hashlib, io, multiprocessing, os, queue, re, struct, tarfile, tempfile, threading, zipfile, zlib
+from collections import OrderedDict
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from functools import lru_cache
+
+# ====================== CONFIG DE SEGURIDAD ======================
+MAX_DEPTH = 3                     # Profundidad máxima de compresión anidada
+MAX_TOTAL_BYTES = 200 * 1024**2   # 200 MB descomprimidos
+ALLOWED_ARCHIVE_EXTS = {".zip", ".tar", ".gz", ".tgz", ".7z", ".rar"}
+SPOOL_MAX_BYTES = 1 * 1024**2     # miembros extraídos: hasta 1 MB en RAM, más grandes a disco
+
+# Procesos hijos sin fork: hacer fork del servidor de Streamlit (multihilo) no es seguro
+MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+# Soportes opcionales
+try:
+    import py7zr
+    _HAS_PY7ZR = True
+except Exception:
+    _HAS_PY7ZR = False
+
+try:
+    import rarfile
+    _HAS_RAR = True
+except Exception:
+    _HAS_RAR = False
+
+try:
+    import deflate   # libdeflate: inflate de buffer completo para miembros ZIP chicos
+    _HAS_LIBDEFLATE = True
+except Exception:
+    _HAS_LIBDEFLATE = False
+
+try:
+    import libarchive
+    _HAS_LIBARCHIVE = True
+except Exception:
+    _HAS_LIBARCHIVE = False
+
+
+# ====================== HELPERS ======================
+# Una sola búsqueda anclada al final en vez de lower() + varios endswith()
+_EXT_RE = re.compile(r"(\.tar\.gz|\.tgz|\.xml|\.pdf|\.zip|\.tar|\.gz|\.7z|\.rar)\Z", re.IGNORECASE)
+
+@lru_cache(maxsize=8192)
+def _lower_ext(name: str) -> str:
+    m = _EXT_RE.search(name)
+    if not m:
+        return ""
+    ext = m.group(1).lower()
+    return ".tgz" if ext == ".tar.gz" else ext
+
+# Firmas de comprimidos: el nombre puede mentir (un .7z como .zip, un comprimido sin extensión)
+_FIRMAS = (
+    (b"PK\003\004", ".zip"), (b"PK\005\006", ".zip"),
+    (b"7z\xbc\xaf\x27\x1c", ".7z"), (b"Rar!\x1a\x07", ".rar"), (b"\x1f\x8b", ".gz"),
+)
+
+def _sniff(data) -> str:
+    """Tipo de comprimido según los primeros 512 bytes ("" si no es uno conocido)."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        head = bytes(data[:512])
+    else:
+        data.seek(0)
+        head = data.read(512)
+        data.seek(0)
+    for firma, ext in _FIRMAS:
+        if head.startswith(firma):
+            return ext
+    if head[257:262] != b"ustar":
+        return ""
+    # "ustar" en el byte 257 puede ser texto cualquiera (p.ej. "ajustar" en un XML):
+    # sólo es tar si además la cabecera de 512 bytes trae un checksum válido
+    try:
+        tarfile.TarInfo.frombuf(head[:512], "utf-8", "surrogateescape")
+    except tarfile.HeaderError:
+        return ""
+    return ".tar"
+
+def _tipo_comprimido(name: str, data) -> str:
+    """
+    Extensión con la que se abre el comprimido ("" si no lo es): primero la firma, luego
+    el nombre. Un .xml/.pdf no se inspecciona: se toma por lo que dice su nombre.
+    """
+    ext = _lower_ext(name)
+    if ext in (".xml", ".pdf"):
+        return ""
+    return _sniff(data) or (ext if ext in ALLOWED_ARCHIVE_EXTS else "")
+
+def _interesa(name: str) -> bool:
+    """True si el miembro vale la pena descomprimir (XML, PDF o comprimido anidado)."""
+    ext = _lower_ext(name)
+    return ext in (".xml", ".pdf") or ext in ALLOWED_ARCHIVE_EXTS
+
+class LimiteExcedido(ValueError):
+    """Se superó el presupuesto de bytes descomprimidos."""
+
+def _safe_add(total_bytes: int, add: int, limite: int = MAX_TOTAL_BYTES) -> int:
+    new_total = total_bytes + add
+    if new_total > limite:
+        raise LimiteExcedido(
+            f"Se superó el límite total descomprimido ({MAX_TOTAL_BYTES/1024**2:.0f} MB)."
+        )
+    return new_total
+
+def as_fileobj(src):
+    """bytes -> BytesIO; un file-like (p.ej. UploadedFile) se usa tal cual, rebobinado."""
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return io.BytesIO(src)
+    src.seek(0)
+    return src
+
+def read_all(src) -> bytes:
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        return bytes(src)
+    # UploadedFile/BytesIO: getvalue() no depende del cursor (un segundo read() daría b"")
+    if hasattr(src, "getvalue"):
+        return src.getvalue()
+    src.seek(0)
+    return src.read()
+
+_COPY_BUF_SIZE = 256 * 1024
+_BUF_POOL = queue.LifoQueue()   # bytearrays reutilizables para copiar miembros
+
+def _spool_miembro(src, limite: int = MAX_TOTAL_BYTES):
+    """
+    Copia un miembro (stream abierto de zip/tar/rar, o bytes) a un SpooledTemporaryFile:
+    los chicos quedan en RAM y los grandes pasan a disco. Se devuelve rebobinado.
+    La copia se corta al pasar `limite` (tamaño declarado falso o ausente).
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    if isinstance(src, (bytes, bytearray, memoryview)):
+        _safe_add(0, memoryview(src).nbytes, limite)
+        out.write(src)
+        out.seek(0)
+        return out
+    try:
+        buf = _BUF_POOL.get_nowait()
+    except queue.Empty:
+        buf = bytearray(_COPY_BUF_SIZE)
+    copiado = 0
+    try:
+        mv = memoryview(buf)
+        while True:
+            n = src.readinto(mv)
+            if not n:
+                break
+            copiado = _safe_add(copiado, n, limite)
+            out.write(mv[:n])
+    except Exception:
+        out.close()
+        raise
+    finally:
+        _BUF_POOL.put(buf)
+    out.seek(0)
+    return out
+
+def _tamano(fp) -> int:
+    fp.seek(0, io.SEEK_END)
+    n = fp.tell()
+    fp.seek(0)
+    return n
+
+_LIBDEFLATE_MAX = 2 * 1024**2       # miembros DEFLATE hasta 2 MB se inflan de una vez
+_ZIP_LOCAL_HDR = struct.Struct("<4s2B4HL2L2H")
+
+def _zip_inflate_libdeflate(fobj, info) -> bytes:
+    """Lee el DEFLATE crudo del miembro (vía header_offset) y lo infla con libdeflate."""
+    fobj.seek(info.header_offset)
+    hdr = _ZIP_LOCAL_HDR.unpack(fobj.read(_ZIP_LOCAL_HDR.size))
+    fobj.seek(hdr[10] + hdr[11], io.SEEK_CUR)   # nombre + extra de la cabecera local
+    out = deflate.deflate_decompress(fobj.read(info.compress_size), info.file_size)
+    if zlib.crc32(out) != info.CRC:
+        raise zipfile.BadZipFile(f"CRC incorrecto en '{info.filename}'")
+    return bytes(out)   # deflate_decompress devuelve bytearray
+
+# Los _iter_* validan el tamaño DECLARADO de cada miembro contra `presupuesto`
+# antes de descomprimirlo: una bomba se corta sin gastar CPU inflándola.
+def _iter_zip(data, presupuesto: int = MAX_TOTAL_BYTES):
+    fobj = as_fileobj(data)
+    declarado = 0
+    with zipfile.ZipFile(fobj) as zf:
+        # Filtra con el directorio central antes de tocar los datos
+        infos = [i for i in zf.infolist() if not i.is_dir() and _interesa(i.filename)]
+        for info in infos:
+            declarado = _safe_add(declarado, info.file_size, presupuesto)
+            if (_HAS_LIBDEFLATE and info.compress_type == zipfile.ZIP_DEFLATED
+                    and info.file_size < _LIBDEFLATE_MAX and not info.flag_bits & 0x1):
+                yield info.filename, _spool_miembro(_zip_inflate_libdeflate(fobj, info), presupuesto)
+                continue
+            with zf.open(info) as src:
+                yield info.filename, _spool_miembro(src, presupuesto)
+
+def _iter_tar_like(data, presupuesto: int = MAX_TOTAL_BYTES):
+    declarado = 0
+    fobj = raw = as_fileobj(data)
+    if _sniff(fobj) == ".gz":
+        # .tgz: se infla de una vez a un temporal (acotado al presupuesto) y el tar se lee
+        # sin compresión, en vez de ir pidiendo bloques chicos a GzipFile por cada miembro
+        with gzip.GzipFile(fileobj=fobj, mode="rb") as gz:
+            fobj = raw = _spool_miembro(gz, presupuesto)
+    try:
+        with tarfile.open(fileobj=fobj, mode="r:*") as tf:
+            for m in tf:   # perezoso: getmembers() recorrería todo antes
+                if not m.isfile() or not _interesa(m.name):
+                    continue
+                declarado = _safe_add(declarado, m.size, presupuesto)
+                f = tf.extractfile(m)
+                if not f:
+                    continue
+                yield m.name, _spool_miembro(f, presupuesto)
+    finally:
+        if raw is not data:
+            raw.close()
+
+if _HAS_PY7ZR and hasattr(py7zr, "io") and hasattr(py7zr.io, "WriterFactory"):   # py7zr >= 1.0
+    class _Spool7zIO(py7zr.io.Py7zIO):
+        """Miembro de un .7z descomprimido directo a un SpooledTemporaryFile."""
+        def __init__(self, factory):
+            self.factory = factory
+            self.fp = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+
+        def write(self, s) -> int:
+            # Como BytesIOFactory: pasado el límite se descarta (se avisa al terminar)
+            self.factory.total += len(s)
+            if self.factory.total > self.factory.limite:
+                return 0
+            return self.fp.write(s)
+
+        def read(self, size=None) -> bytes:
+            return self.fp.read(size)
+
+        def seek(self, offset: int, whence: int = 0) -> int:
+            return self.fp.seek(offset, whence)
+
+        def flush(self) -> None:
+            self.fp.flush()
+
+        def size(self) -> int:
+            pos = self.fp.tell()
+            n = self.fp.seek(0, io.SEEK_END)
+            self.fp.seek(pos)
+            return n
+
+    class _Spool7zFactory(py7zr.io.WriterFactory):
+        def __init__(self, limite: int):
+            self.limite = limite
+            self.total = 0
+            self.products = {}
+
+        def create(self, filename: str):
+            product = _Spool7zIO(self)
+            self.products[filename] = product
+            return product
+
+def _iter_7z(data, presupuesto: int = MAX_TOTAL_BYTES):
+    if not _HAS_PY7ZR:
+        raise RuntimeError("py7zr no está instalado. Agrega 'py7zr' a requirements.txt")
+    with py7zr.SevenZipFile(as_fileobj(data), mode='r') as z:
+        sizes = {f.filename: f.uncompressed or 0 for f in z.list() if not f.is_directory}
+        targets = [n for n in sizes if _interesa(n)]
+        if not targets:
+            return
+        _safe_add(0, sum(sizes[n] for n in targets), presupuesto)
+        if hasattr(z, "read"):      # py7zr < 1.0
+            for name, bio in z.read(targets=targets).items():
+                bio.seek(0)
+                yield name, _spool_miembro(bio, presupuesto)
+            return
+        # py7zr >= 1.0: cada miembro se descomprime directo a su SpooledTemporaryFile
+        factory = _Spool7zFactory(presupuesto)
+        z.extract(targets=targets, factory=factory)
+        _safe_add(0, factory.total, presupuesto)
+        for name, product in factory.products.items():
+            product.fp.seek(0)
+            yield name, product.fp
+
+def _iter_rar(data, presupuesto: int = MAX_TOTAL_BYTES):
+    if not _HAS_RAR:
+        raise RuntimeError("rarfile no está instalado. Agrega 'rarfile' a requirements.txt")
+    declarado = 0
+    with rarfile.RarFile(as_fileobj(data)) as rf:
+        for info in rf.infolist():
+            if info.is_dir() or not _interesa(info.filename):
+                continue
+            declarado = _safe_add(declarado, info.file_size, presupuesto)
+            with rf.open(info) as f:
+                yield info.filename, _spool_miembro(f, presupuesto)
+
+def _iter_libarchive(data, presupuesto: int = MAX_TOTAL_BYTES):
+    """tar/tgz/gz/7z/rar en streaming con libarchive (C), sin py7zr/rarfile/tarfile."""
+    declarado = 0
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        reader = libarchive.memory_reader(bytes(data))
+    else:
+        reader = libarchive.stream_reader(as_fileobj(data))
+    with reader as archive:
+        for entry in archive:
+            if not entry.isfile or not _interesa(entry.pathname):
+                continue
+            if entry.size:   # puede no venir declarado (p.ej. .gz en streaming)
+                declarado = _safe_add(declarado, entry.size, presupuesto)
+            out = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+            copiado = 0
+            try:
+                for block in entry.get_blocks():
+                    copiado = _safe_add(copiado, len(block), presupuesto)   # .gz no declara tamaño
+                    out.write(block)
+            except Exception:
+                out.close()
+                raise
+            out.seek(0)
+            yield entry.pathname, out
+
+_DISPATCH = {
+    ".zip": _iter_zip,
+    ".tar": _iter_tar_like, ".gz": _iter_tar_like, ".tgz": _iter_tar_like,
+    ".7z": _iter_7z,
+    ".rar": _iter_rar,
+}
+if _HAS_LIBARCHIVE:
+    _DISPATCH.update(dict.fromkeys((".tar", ".gz", ".tgz", ".7z", ".rar"), _iter_libarchive))
+
+def _dispatch_iter(ext: str, data, presupuesto: int = MAX_TOTAL_BYTES):
+    """`ext` es el tipo ya resuelto por _tipo_comprimido."""
+    try:
+        iterador = _DISPATCH[ext]
+    except KeyError:
+        raise ValueError(f"Extensión no soportada: {ext}") from None
+    return iterador(data, presupuesto)
+
+# Digest por adjunto, memorizado por file_id: en cada rerun Streamlit entrega el mismo
+# archivo subido con el mismo file_id, así que no hace falta volver a hashear su contenido
+_HUELLAS_MAX = 512
+_huellas: "OrderedDict[tuple, bytes]" = OrderedDict()
+_huellas_lock = threading.Lock()   # las sesiones corren en hilos distintos
+
+def _huella_archivo(up) -> bytes:
+    file_id = getattr(up, "file_id", None)
+    if file_id is None:
+        return hashlib.blake2b(up.getvalue(), digest_size=16).digest()
+    clave = (file_id, up.name, up.size)
+    with _huellas_lock:
+        digest = _huellas.get(clave)
+        if digest is not None:
+            _huellas.move_to_end(clave)
+            return digest
+    digest = hashlib.blake2b(up.getvalue(), digest_size=16).digest()
+    with _huellas_lock:
+        _huellas[clave] = digest
+        if len(_huellas) > _HUELLAS_MAX:
+            _huellas.popitem(last=False)
+    return digest
+
+def huella_adjuntos(uploads) -> str:
+    """Hash (blake2b) de nombres + contenido subido, para reusar resultados entre reruns."""
+    h = hashlib.blake2b(digest_size=16)
+    for up in uploads:
+        h.update(up.name.encode("utf-8"))
+        h.update(_huella_archivo(up))
+    return h.hexdigest()
+
+@lru_cache(maxsize=8192)
+def basename_inside(name: str) -> str:
+    """
+    Devuelve el nombre base del archivo, incluso si viene de dentro de un comprimido.
+    'outer.zip!/carpeta/archivo.xml' -> 'archivo.xml'
+    """
+    # Toma la parte después del último '!/' si existe
+    inner = name.split("!/")[-1]
+    # Luego toma solo el filename
+    return os.path.basename(inner)
+
+
+# ====================== EXTRACCIÓN ======================
+def iterar_archivo(name: str, data, max_depth: int = MAX_DEPTH, presupuesto: int = MAX_TOTAL_BYTES, avisos=None):
+    """
+    Generador: recorre un comprimido (y sus anidados) en profundidad y entrega cada
+    XML/PDF como (nombre_compuesto, SpooledTemporaryFile) apenas se extrae, sin juntar
+    la lista completa. Sólo los comprimidos de la rama actual están abiertos a la vez.
+    Los problemas se agregan a `avisos` como ("warning"|"error", mensaje).
+    Al agotarse devuelve (return) (consumido, excedido): los bytes descomprimidos
+    contabilizados y si algún comprimido se cortó por superar `presupuesto`.
+    """
+    avisos = [] if avisos is None else avisos
+    consumido = 0
+    excedido = False
+
+    def _walk(name, data, depth, tipo):
+        nonlocal consumido, excedido
+        if depth >= max_depth:
+            avisos.append(("warning", f"Se omitió contenido anidado en '{name}' (profundidad > {max_depth})."))
+            return
+        try:
+            for inner_name, inner_fp in _dispatch_iter(tipo, data, presupuesto - consumido):
+                consumido = _safe_add(consumido, _tamano(inner_fp), presupuesto)
+                composed = f"{name}!/{inner_name}"
+                inner_tipo = _tipo_comprimido(inner_name, inner_fp)
+                if inner_tipo:
+                    with inner_fp:
+                        yield from _walk(composed, inner_fp, depth + 1, inner_tipo)
+                elif _lower_ext(inner_name) in (".xml", ".pdf"):
+                    yield composed, inner_fp
+                else:
+                    inner_fp.close()
+        except Exception as e:
+            excedido = excedido or isinstance(e, LimiteExcedido)
+            avisos.append(("error", f"No se pudo leer el archivo comprimido '{name}': {e}"))
+
+    tipo = _tipo_comprimido(name, data)
+    if tipo:
+        yield from _walk(name, data, 0, tipo)
+    elif _lower_ext(name) in (".xml", ".pdf"):
+        yield name, data
+    return consumido, excedido
+
+def extraer_archivo(name: str, data, max_depth: int = MAX_DEPTH, presupuesto: int = MAX_TOTAL_BYTES):
+    """
+    iterar_archivo consumido entero -> (hojas, consumido, avisos, excedido):
+      hojas:     [(nombre_compuesto, bytes)] sólo XML/PDF, en orden de profundidad
+      consumido: bytes descomprimidos contabilizados
+      avisos:    [("warning"|"error", mensaje)] para mostrar en la UI
+      excedido:  True si se cortó por superar `presupuesto`
+    Función de módulo (picklable) para ProcessPoolExecutor: las hojas vuelven como
+    bytes porque un SpooledTemporaryFile no se puede enviar entre procesos.
+    """
+    hojas, avisos = [], []
+    it = iterar_archivo(name, data, max_depth, presupuesto, avisos)
+    while True:
+        try:
+            n, fp = next(it)
+        except StopIteration as fin:
+            consumido, excedido = fin.value
+            return hojas, consumido, avisos, excedido
+        with fp:
+            hojas.append((n, read_all(fp)))
+
+def iterar_adjuntos(uploads, max_depth: int = MAX_DEPTH, avisos=None, executor=None):
+    """
+    Generador sobre los archivos subidos: entrega (nombre, UploadedFile | SpooledTemporaryFile)
+    por cada XML/PDF; primero los sueltos, luego el contenido de cada comprimido en el
+    orden de subida. Léelos con read_all (los miembros grandes viven en disco, no en RAM).
+    Los problemas se agregan a `avisos` como ("warning"|"error", mensaje).
+    Con un solo comprimido se extrae en este proceso y de forma perezosa; con más de uno,
+    cada uno en su propio proceso (descompresión y parseo de tarfile/py7zr/rarfile en
+    Python puro no escalan con hilos por el GIL): en `executor` si se pasa uno
+    (p.ej. el pool compartido de la página), si no en un pool creado para la llamada.
+    Cada hijo recibe una cuota igual del presupuesto, así lo que vuelve a este proceso
+    nunca pasa de MAX_TOTAL_BYTES; el comprimido que no cabe en su cuota se extrae
+    aquí al final, de forma perezosa y con lo que quede del presupuesto.
+    """
+    avisos = [] if avisos is None else avisos
+    total_bytes = 0
+    comprimidos = []
+    for up in uploads:
+        total_bytes = _safe_add(total_bytes, up.size)
+        if _tipo_comprimido(up.name, up):
+            comprimidos.append(up)
+        elif _lower_ext(up.name) in (".xml", ".pdf"):
+            yield up.name, up
+
+    presupuesto = MAX_TOTAL_BYTES - total_bytes
+    if len(comprimidos) <= 1:
+        # Sobre el propio UploadedFile (sin copiarlo); el presupuesto ya descuenta lo subido
+        for up in comprimidos:
+            yield from iterar_archivo(up.name, up, max_depth, presupuesto, avisos)
+        return
+
+    cuota = presupuesto // len(comprimidos)
+
+    def _resultado(up, fut):
+        if fut is not None:
+            try:
+                return fut.result()
+            except BrokenExecutor:
+                pass
+        # un proceso hijo murió (o el pool ya estaba roto): se extrae aquí
+        return extraer_archivo(up.name, up, max_depth, cuota)
+
+    propio = executor is None
+    ex = ProcessPoolExecutor(
+        max_workers=min(len(comprimidos), os.cpu_count() or 1), mp_context=MP_CONTEXT
+    ) if propio else executor
+    excedidos = []
+    try:
+        try:
+            futs = [ex.submit(extraer_archivo, up.name, up.getvalue(), max_depth, cuota)
+                    for up in comprimidos]
+        except BrokenExecutor:
+            futs = [None] * len(comprimidos)
+        for up, fut in zip(comprimidos, futs):
+            sub_hojas, consumido, sub_avisos, excedido = _resultado(up, fut)
+            if excedido:
+                excedidos.append(up)
+                continue
+            avisos.extend(sub_avisos)
+            total_bytes += consumido
+            for n, b in sub_hojas:
+                yield n, _spool_miembro(b)
+    finally:
+        if propio:
+            ex.shutdown(cancel_futures=True)
+
+    for up in excedidos:
+        consumido, _ = yield from iterar_archivo(up.name, up, max_depth, MAX_TOTAL_BYTES - total_bytes, avisos)
+        total_bytes += consumido
+
+def colectar_xml_pdf(uploads, max_depth: int = MAX_DEPTH, avisos=None, executor=None, excluir_r: bool = True):
+    """
+    iterar_adjuntos clasificado -> (xml_files, pdf_files, omitidos_r):
+      xml_files, pdf_files: [(nombre_compuesto, archivo)] en orden; leer con read_all
+      omitidos_r:           XML descartados por empezar su nombre base con 'R-'
+                            (sólo si excluir_r; los PDF nunca se excluyen)
+    """
+    xml_files, pdf_files = [], []
+    omitidos_r = 0
+    for name, data in iterar_adjuntos(uploads, max_depth, avisos, executor):
+        ext = _lower_ext(name)
+        if ext == ".xml":
+            if excluir_r and basename_inside(name).lower().startswith("r-"):
+                omitidos_r += 1
+                continue
+            xml_files.append((name, data))
+        elif ext == ".pdf":
+            pdf_files.append((name, data))
+    return xml_files, pdf_files, omitidos_r
@@ -1,32 +1,82 @@
 
-import io, os, re, xml.etree.ElementTree as ET
+import hashlib, io, os, re, struct, tempfile, threading, time, unicodedata, zlib, xml.etree.ElementTree as ET
+from collections import OrderedDict, defaultdict
+from concurrent.futures import BrokenExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 
 import fitz  # PyMuPDF
 import pandas as pd
+import xlsxwriter
+
+from utils.archivos import read_all
+from utils.xml_meta import PARALLEL_MIN_XML
+
+# libdeflate (opcional): DEFLATE de buffer completo, más rápido que zlib
+try:
+    import deflate
+    _HAS_LIBDEFLATE = True
+except Exception:
+    _HAS_LIBDEFLATE = False
+
+# lxml (opcional): parseo y XPath compilados en libxml2; sin él, ElementTree
+try:
+    from lxml import etree as LET
+    _HAS_LXML = True
+except Exception:
+    _HAS_LXML = False
+
+# python-calamine (opcional): lector de Excel en Rust, bastante más rápido que openpyxl
+# y también lee .xls/.ods; sin él pandas elige el motor según la extensión
+try:
+    import python_calamine  # noqa: F401
+    _HAS_CALAMINE = True
+except Exception:
+    _HAS_CALAMINE = False
+EXCEL_ENGINE = "calamine" if _HAS_CALAMINE else None
 
 NS = {
     'cbc': 'urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2',
     'cac': 'urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2'
 }
 
+# Regex precompiladas (se usan por archivo / por fila)
+NON_DIGIT_RE   = re.compile(r'\D')
+ID_FACTURA_RE  = re.compile(r'^[A-Za-z0-9]{1,4}-[0-9A-Za-z]+$')
+DOC_NUMERO_RE  = re.compile(r'^[A-Z0-9]{1,4}-(\d{1,})$')
+DOC_VALIDO_RE  = re.compile(r'^[A-Z0-9]{1,4}-\d{1,}$', re.IGNORECASE)
+DIGITOS_11_RE  = re.compile(r'[0-9]{11,}')   # ASCII: igual que la búsqueda por subcadena
+
 def _gettext(node):
     return (node.text or '').strip() if (node is not None and node.text) else None
 
+def _buscar(node, path):
+    """Elementos que cumplen `path` desde node, en orden del documento."""
+    if _HAS_LXML and isinstance(node, LET._Element):
+        return _lxml()[1][path](node)
+    return node.iterfind(path, NS)
+
 def _findtext(root, path):
+    if _HAS_LXML and isinstance(root, LET._Element):
+        hallados = _lxml()[1][path](root)
+        return _gettext(hallados[0] if hallados else None)
     el = root.find(path, NS)
     return _gettext(el)
 
+@lru_cache(maxsize=65536)
+def _sin_marcas(s: str) -> str:
+    """NFD sin marcas combinantes (tildes); memorizado: los nombres de lugar se repiten mucho."""
+    return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
+
 def normaliza(s):
     if s is None:
         return None
-    import unicodedata
     s = str(s).strip().upper()
-    s = ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
-    return s
+    return s if s.isascii() else _sin_marcas(s)   # ASCII: NFD no cambia nada
 
 def limpiar_numero(s: str) -> str:
-    return re.sub(r'\D', '', str(s) if s is not None else '')
+    s = str(s) if s is not None else ''
+    return s if s.isdecimal() else NON_DIGIT_RE.sub('', s)
 
 # ===== UBIGEO LOADERS =====
 def cargar_ubigeo_local(path="ubigeo.xlsx"):
@@ -36,7 +86,7 @@ def cargar_ubigeo_local(path="ubigeo.xlsx"):
             if ext == ".csv":
                 return pd.read_csv(path, dtype=str, encoding="utf-8-sig")
             else:
-                xls = pd.ExcelFile(path)
+                xls = pd.ExcelFile(path, engine=EXCEL_ENGINE)
                 sheet = "Table 1" if "Table 1" in xls.sheet_names else xls.sheet_names[0]
                 return pd.read_excel(xls, sheet_name=sheet, dtype=str)
         except Exception:
@@ -45,7 +95,7 @@ def cargar_ubigeo_local(path="ubigeo.xlsx"):
 
 def cargar_tabla_ubigeo_excel_bytes(excel_bytes: bytes):
     try:
-        xls = pd.ExcelFile(io.BytesIO(excel_bytes))
+        xls = pd.ExcelFile(io.BytesIO(excel_bytes), engine=EXCEL_ENGINE)
         sheet = 'Table 1' if 'Table 1' in xls.sheet_names else xls.sheet_names[0]
         df = pd.read_excel(xls, sheet_name=sheet, dtype=str)
         return df
@@ -53,27 +103,108 @@ def cargar_tabla_ubigeo_excel_bytes(excel_bytes: bytes):
         return None
 
 # ===== XML / PDF UTILS =====
-def extraer_datos_xml_bytes(xml_bytes):
-    def _es_id_factura(s: str) -> bool:
-        if not s:
-            return False
-        s = s.strip()
-        if s.count('-') != 1:
-            return False
-        return bool(re.match(r'^[A-Za-z0-9]{1,4}-[0-9A-Za-z]+$', s))
+# Rutas de búsqueda (se prueban en orden; gana la primera con valor)
+RUC_EMISOR_XPATHS = (
+    './/cac:AccountingSupplierParty//cbc:ID',
+    './/cac:AccountingSupplierParty//cac:PartyLegalEntity/cbc:CompanyID',
+    './/cac:SellerSupplierParty//cbc:ID',
+    './/cac:SellerSupplierParty//cac:PartyLegalEntity/cbc:CompanyID',
+    './/cac:SenderParty//cbc:CompanyID',
+    './/cac:SenderParty//cac:PartyLegalEntity/cbc:CompanyID',
+)
+RUC_PAGADOR_XPATHS = (
+    './/cac:AccountingCustomerParty//cbc:ID',
+    './/cac:AccountingCustomerParty//cac:PartyLegalEntity/cbc:CompanyID',
+    './/cac:BuyerCustomerParty//cbc:ID',
+    './/cac:BuyerCustomerParty//cac:PartyLegalEntity/cbc:CompanyID',
+    './/cac:ReceiverParty//cbc:CompanyID',
+    './/cac:ReceiverParty//cac:PartyLegalEntity/cbc:CompanyID',
+)
+
+SUP_CITY_XPATHS = (
+    './/cac:AccountingSupplierParty//cac:PostalAddress/cbc:CityName',
+    './/cac:AccountingSupplierParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:CityName',
+    './/cac:SellerSupplierParty//cac:PostalAddress/cbc:CityName',
+)
+SUP_SUBENTITY_XPATHS = (
+    './/cac:AccountingSupplierParty//cac:PostalAddress/cbc:CountrySubentity',
+    './/cac:AccountingSupplierParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:CountrySubentity',
+    './/cac:SellerSupplierParty//cac:PostalAddress/cbc:CountrySubentity',
+)
+SUP_DISTRICT_XPATHS = (
+    './/cac:AccountingSupplierParty//cac:PostalAddress/cbc:District',
+    './/cac:AccountingSupplierParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:District',
+    './/cac:SellerSupplierParty//cac:PostalAddress/cbc:District',
+)
+CUS_CITY_XPATHS = (
+    './/cac:AccountingCustomerParty//cac:PostalAddress/cbc:CityName',
+    './/cac:BuyerCustomerParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:CityName',
+)
+CUS_SUBENTITY_XPATHS = (
+    './/cac:AccountingCustomerParty//cac:PostalAddress/cbc:CountrySubentity',
+    './/cac:BuyerCustomerParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:CountrySubentity',
+)
+CUS_DISTRICT_XPATHS = (
+    './/cac:AccountingCustomerParty//cac:PostalAddress/cbc:District',
+    './/cac:BuyerCustomerParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:District',
+)
+
+_RUTAS_ID = ('.//cac:DocumentReference', './cbc:DocumentTypeCode', './cbc:ID', './/cbc:ID')
+_lxml_local = threading.local()
+
+def _lxml():
+    """
+    (parser, {ruta: XPath compilado}) de lxml para el hilo actual: ni el parser ni los
+    XPath se comparten entre hilos. El parser arma el mismo árbol que ElementTree
+    (sin comentarios ni PI, sólo entidades internas).
+    """
+    cache = getattr(_lxml_local, "cache", None)
+    if cache is None:
+        parser = LET.XMLParser(remove_comments=True, remove_pis=True, resolve_entities="internal")
+        rutas = (_RUTAS_ID + RUC_EMISOR_XPATHS + RUC_PAGADOR_XPATHS
+                 + SUP_CITY_XPATHS + SUP_SUBENTITY_XPATHS + SUP_DISTRICT_XPATHS
+                 + CUS_CITY_XPATHS + CUS_SUBENTITY_XPATHS + CUS_DISTRICT_XPATHS)
+        cache = _lxml_local.cache = (parser, {r: LET.XPath(r, namespaces=NS) for r in rutas})
+    return cache
+
+def _parse_xml(xml_bytes):
+    if _HAS_LXML:
+        try:
+            return LET.fromstring(xml_bytes, _lxml()[0])
+        except Exception:
+            pass   # lo que libxml2 rechaza (p.ej. por sus límites) se intenta con ElementTree
+    return ET.fromstring(xml_bytes)
 
-    def _pick_first_text(root_node, paths):
-        for p in paths:
-            val = _findtext(root_node, p)
-            if val:
-                return normaliza(val)
-        return None
+def _es_id_factura(s: str) -> bool:
+    if not s:
+        return False
+    s = s.strip()
+    if s.count('-') != 1:
+        return False
+    return bool(ID_FACTURA_RE.match(s))
 
+def _pick_first_text(root_node, paths):
+    for p in paths:
+        val = _findtext(root_node, p)
+        if val:
+            return normaliza(val)
+    return None
+
+def _find_ruc_any(root_node, xpaths):
+    for xp in xpaths:
+        for tag in _buscar(root_node, xp):
+            if tag is not None and tag.attrib.get('schemeID') == '6' and tag.text:
+                val = tag.text.strip()
+                if val:
+                    return val
+    return None
+
+def extraer_datos_xml_bytes(xml_bytes):
     try:
-        root = ET.fromstring(xml_bytes)
+        root = _parse_xml(xml_bytes)
 
         id_factura = None
-        for dr in root.findall('.//cac:DocumentReference', NS):
+        for dr in _buscar(root, './/cac:DocumentReference'):
             dtc = _findtext(dr, './cbc:DocumentTypeCode')
             if (dtc or '').strip() == '01':
                 cand = _findtext(dr, './cbc:ID')
@@ -87,7 +218,7 @@ def extraer_datos_xml_bytes(xml_bytes):
                 id_factura = cand.strip()
 
         if not id_factura:
-            for tag in root.findall('.//cbc:ID', NS):
+            for tag in _buscar(root, './/cbc:ID'):
                 t = _gettext(tag)
                 if t and _es_id_factura(t):
                     id_factura = t.strip()
@@ -97,67 +228,15 @@ def extraer_datos_xml_bytes(xml_bytes):
         if id_factura and '-' in id_factura:
             serie, numero = id_factura.split('-', 1)
 
-        def _find_ruc_any(root_node, xpaths):
-            for xp in xpaths:
-                for tag in root_node.findall(xp, NS):
-                    if tag is not None and tag.attrib.get('schemeID') == '6' and tag.text:
-                        val = tag.text.strip()
-                        if val:
-                            return val
-            return None
+        ruc_emisor = _find_ruc_any(root, RUC_EMISOR_XPATHS)
+        ruc_pagador = _find_ruc_any(root, RUC_PAGADOR_XPATHS)
 
-        ruc_emisor = _find_ruc_any(root, [
-            './/cac:AccountingSupplierParty//cbc:ID',
-            './/cac:AccountingSupplierParty//cac:PartyLegalEntity/cbc:CompanyID',
-            './/cac:SellerSupplierParty//cbc:ID',
-            './/cac:SellerSupplierParty//cac:PartyLegalEntity/cbc:CompanyID',
-            './/cac:SenderParty//cbc:CompanyID',
-            './/cac:SenderParty//cac:PartyLegalEntity/cbc:CompanyID',
-        ])
-        ruc_pagador = _find_ruc_any(root, [
-            './/cac:AccountingCustomerParty//cbc:ID',
-            './/cac:AccountingCustomerParty//cac:PartyLegalEntity/cbc:CompanyID',
-            './/cac:BuyerCustomerParty//cbc:ID',
-            './/cac:BuyerCustomerParty//cac:PartyLegalEntity/cbc:CompanyID',
-            './/cac:ReceiverParty//cbc:CompanyID',
-            './/cac:ReceiverParty//cac:PartyLegalEntity/cbc:CompanyID',
-        ])
-
-        sup_city = _pick_first_text(root, [
-            './/cac:AccountingSupplierParty//cac:PostalAddress/cbc:CityName',
-            './/cac:AccountingSupplierParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:CityName',
-            './/cac:SellerSupplierParty//cac:PostalAddress/cbc:CityName',
-        ])
-        sup_subentity = _pick_first_text(root, [
-            './/cac:AccountingSupplierParty//cac:PostalAddress/cbc:CountrySubentity',
-            './/cac:AccountingSupplierParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:CountrySubentity',
-            './/cac:SellerSupplierParty//cac:PostalAddress/cbc:CountrySubentity',
-        ])
-        sup_district = _pick_first_text(root, [
-            './/cac:AccountingSupplierParty//cac:PostalAddress/cbc:District',
-            './/cac:AccountingSupplierParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:District',
-            './/cac:SellerSupplierParty//cac:PostalAddress/cbc:District',
-        ])
-
-        cus_city = _pick_first_text(root, [
-            './/cac:AccountingCustomerParty//cac:PostalAddress/cbc:CityName',
-            './/cac:BuyerCustomerParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:CityName',
-        ])
-        cus_subentity = _pick_first_text(root, [
-            './/cac:AccountingCustomerParty//cac:PostalAddress/cbc:CountrySubentity',
-            './/cac:BuyerCustomerParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:CountrySubentity',
-        ])
-        cus_district = _pick_first_text(root, [
-            './/cac:AccountingCustomerParty//cac:PostalAddress/cbc:District',
-            './/cac:BuyerCustomerParty//cac:PartyLegalEntity//cac:RegistrationAddress/cbc:District',
-        ])
-
-        sup_city      = normaliza(sup_city)
-        sup_subentity = normaliza(sup_subentity)
-        sup_district  = normaliza(sup_district)
-        cus_city      = normaliza(cus_city)
-        cus_subentity = normaliza(cus_subentity)
-        cus_district  = normaliza(cus_district)
+        sup_city      = normaliza(_pick_first_text(root, SUP_CITY_XPATHS))
+        sup_subentity = normaliza(_pick_first_text(root, SUP_SUBENTITY_XPATHS))
+        sup_district  = normaliza(_pick_first_text(root, SUP_DISTRICT_XPATHS))
+        cus_city      = normaliza(_pick_first_text(root, CUS_CITY_XPATHS))
+        cus_subentity = normaliza(_pick_first_text(root, CUS_SUBENTITY_XPATHS))
+        cus_district  = normaliza(_pick_first_text(root, CUS_DISTRICT_XPATHS))
 
         return (
             id_factura, ruc_emisor, ruc_pagador, serie, numero,
@@ -167,59 +246,186 @@ def extraer_datos_xml_bytes(xml_bytes):
     except Exception:
         return (None, None, None, None, None, None, None, None, None, None, None)
 
-def pdf_contiene_datos(pdf_bytes, ruc_emisor, serie, numero):
+def _map_archivos(fn, archivos, executor=None):
+    """
+    fn(bytes) sobre cada (nombre, contenido) de `archivos`, en el mismo orden.
+    Con un executor (ProcessPoolExecutor) y lotes de al menos PARALLEL_MIN_XML archivos,
+    el trabajo se reparte entre procesos (se les envían los bytes).
+    """
+    if executor is None or len(archivos) < PARALLEL_MIN_XML:
+        return [fn(read_all(c)) for _, c in archivos]
+    payloads = [read_all(c) for _, c in archivos]
+    chunksize = max(1, len(payloads) // (4 * (os.cpu_count() or 1)))
+    try:
+        return list(executor.map(fn, payloads, chunksize=chunksize))
+    except BrokenExecutor:
+        # un proceso hijo murió: se repite en serie
+        return [fn(b) for b in payloads]
+
+# Datos por contenido de XML (digest blake2b), memorizados entre reruns y sesiones: si
+# sólo cambian los PDF o el Excel, los mismos XML no se vuelven a parsear
+_DATOS_XML_MAX = 4096
+_datos_xml: "OrderedDict[bytes, tuple]" = OrderedDict()
+_datos_xml_lock = threading.Lock()   # las sesiones corren en hilos distintos
+
+def extraer_datos_xmls(xml_files, executor=None):
+    """
+    extraer_datos_xml_bytes sobre cada (nombre, contenido) de xml_files, en el mismo orden.
+    Sólo se parsean los contenidos que no estén ya memorizados, una vez cada uno.
+    """
+    claves = [hashlib.blake2b(read_all(c), digest_size=16).digest() for _, c in xml_files]
+    datos = {}
+    with _datos_xml_lock:
+        for clave in claves:
+            if clave not in datos and clave in _datos_xml:
+                _datos_xml.move_to_end(clave)
+                datos[clave] = _datos_xml[clave]
+    faltan = {}
+    for clave, archivo in zip(claves, xml_files):
+        if clave not in datos:
+            faltan.setdefault(clave, archivo)
+    if faltan:
+        nuevos = dict(zip(faltan, _map_archivos(extraer_datos_xml_bytes, list(faltan.values()), executor)))
+        datos.update(nuevos)
+        with _datos_xml_lock:
+            _datos_xml.update(nuevos)
+            while len(_datos_xml) > _DATOS_XML_MAX:
+                _datos_xml.popitem(last=False)
+    return [datos[clave] for clave in claves]
+
+def _iter_textos_pdf(pdf_bytes):
+    """Texto de cada página, en orden; si el PDF falla a mitad, hasta ahí."""
     try:
         with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
             for page in doc:
-                text = page.get_text()
-                if serie and numero and (serie in text) and (numero in text) and (ruc_emisor and ruc_emisor in text):
-                    return True
-        return False
+                yield page.get_text()
     except Exception:
-        return False
+        return
 
-def buscar_ubigeo(dfubi, city, subentity, district):
+def textos_pdf(pdf_bytes) -> tuple:
+    return tuple(_iter_textos_pdf(pdf_bytes))
+
+def _pagina_contiene(text, ruc_emisor, serie, numero) -> bool:
+    return bool(serie and numero and (serie in text) and (numero in text) and (ruc_emisor and ruc_emisor in text))
+
+def pdf_contiene_datos(pdf_bytes, ruc_emisor, serie, numero):
+    return any(_pagina_contiene(t, ruc_emisor, serie, numero) for t in _iter_textos_pdf(pdf_bytes))
+
+def _es_ruc11(s) -> bool:
+    return bool(s) and len(s) == 11 and s.isascii() and s.isdigit()
+
+def indexar_pdfs(pdf_files, executor=None):
+    """
+    Abre cada PDF una sola vez -> (textos, por_ruc):
+      textos:  por PDF, la tupla con el texto de cada página
+      por_ruc: cada secuencia de 11 dígitos que aparece en el texto -> índices de los PDF
+               que la contienen (ascendentes). Es un superconjunto exacto de los PDF que
+               pueden contener un RUC de 11 dígitos, así que basta revisar esos.
+    """
+    textos = _map_archivos(textos_pdf, pdf_files, executor)
+    por_ruc = defaultdict(list)
+    for j, paginas in enumerate(textos):
+        vistos = set()
+        for t in paginas:
+            for m in DIGITOS_11_RE.finditer(t):
+                run = m.group()
+                vistos.update(run[k:k + 11] for k in range(len(run) - 10))
+        for r in vistos:
+            por_ruc[r].append(j)
+    return textos, por_ruc
+
+def indexar_ubigeo(dfubi):
+    """(Departamento, Provincia, Distrito) -> Ubigeo; ante duplicados gana la primera fila."""
     if dfubi is None:
         return None
+    idx = {}
+    cols = ["Departamento", "Provincia", "Distrito", "Ubigeo"]
+    if not set(cols).issubset(dfubi.columns):
+        return idx
+    for dep, prov, dist, ubi in dfubi[cols].itertuples(index=False, name=None):
+        idx.setdefault((dep, prov, dist), ubi)
+    return idx
+
+def buscar_ubigeo(ubi_idx, city, subentity, district):
+    if ubi_idx is None:
+        return None
     if not city or not subentity or not district:
         return None
-    mask = (dfubi.get("Departamento")==city) & (dfubi.get("Provincia")==subentity) & (dfubi.get("Distrito")==district)
-    if mask.any():
-        return dfubi.loc[mask, 'Ubigeo'].iloc[0]
-    return None
+    return ubi_idx.get((city, subentity, district))
+
+# ===== SALIDA XLSX =====
+XLSX_OPCIONES = {
+    "constant_memory": True,        # fila a fila a disco: memoria plana en hojas grandes
+    "strings_to_numbers": False,
+    "strings_to_formulas": False,
+    "strings_to_urls": False,
+    "default_date_format": "yyyy-mm-dd hh:mm:ss",
+}
 
-def emparejar_y_reportar(xml_files, pdf_files, df_ubi):
+def _nuevo_xlsx(buffer):
+    """Workbook de salida + formato de encabezado (el mismo que usa pandas)."""
+    wb = xlsxwriter.Workbook(buffer, XLSX_OPCIONES)
+    return wb, wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+
+def _escribir_filas(wb, fmt_header, sh: str, columnas, filas):
+    """Hoja con encabezado + filas (iterables de valores), escrita fila por fila."""
+    ws = wb.add_worksheet(sh[:31])
+    ws.write_row(0, 0, [str(c) for c in columnas], fmt_header)
+    for r, fila in enumerate(filas, start=1):
+        ws.write_row(r, 0, fila)
+
+def _escribir_hoja(wb, fmt_header, sh: str, df: pd.DataFrame):
+    """
+    Escribe el DataFrame como una hoja (encabezado + filas, sin índice).
+    df.to_excel escribe columna por columna, lo que constant_memory no admite
+    (descarta las celdas de filas ya volcadas): aquí se escribe fila por fila.
+    """
+    valores = df.astype(object).where(df.notna(), None)
+    _escribir_filas(wb, fmt_header, sh, df.columns, valores.itertuples(index=False, name=None))
+
+def emparejar_y_reportar(xml_files, pdf_files, ubi_idx, executor=None, datos=None):
     errores = []
     matches_lines = ["### RONDA 1: Emparejamientos por contenido"]
     usados_pdf_idx = set()
+    textos_pdf_idx = por_ruc = None   # índice de PDFs: se arma con el primer XML válido
     resultado_ordenado = []
     reporte_rows = []
-    for x in xml_files:
-        extracted = extraer_datos_xml_bytes(x['content'])
+    # Los contenidos pueden ser bytes o archivos (UploadedFile/SpooledTemporaryFile):
+    # se leen al usarlos y resultado_ordenado conserva el objeto original.
+    # Los XML se parsean primero (en paralelo si se pasa un executor), salvo que ya
+    # vengan parseados en `datos` (extraer_datos_xmls sobre estos mismos xml_files).
+    if datos is None:
+        datos = extraer_datos_xmls(xml_files, executor)
+    for (x_name, x_content), extracted in zip(xml_files, datos):
         (id_xml, ruc_emisor, ruc_pagador, serie, numero,
          sup_city, sup_subentity, sup_district,
          cus_city, cus_subentity, cus_district) = extracted
         if not id_xml or not ruc_emisor:
-            errores.append(f"{x['filename']} → ❌ No se pudo extraer ID o RUC")
+            errores.append(f"{x_name} → ❌ No se pudo extraer ID o RUC")
             continue
-        ubi_sup = buscar_ubigeo(df_ubi, sup_city, sup_subentity, sup_district) if df_ubi is not None else None
-        ubi_cus = buscar_ubigeo(df_ubi, cus_city, cus_subentity, cus_district) if df_ubi is not None else None
+        ubi_sup = buscar_ubigeo(ubi_idx, sup_city, sup_subentity, sup_district)
+        ubi_cus = buscar_ubigeo(ubi_idx, cus_city, cus_subentity, cus_district)
         encontrado = False
-        for j, p in enumerate(pdf_files):
-            if j in usados_pdf_idx: 
+        if textos_pdf_idx is None:
+            textos_pdf_idx, por_ruc = indexar_pdfs(pdf_files, executor)
+        # Sólo los PDF cuyo texto trae el RUC (en orden); si el RUC no es de 11 dígitos, todos
+        candidatos = por_ruc.get(ruc_emisor, ()) if _es_ruc11(ruc_emisor) else range(len(pdf_files))
+        for j in candidatos:
+            if j in usados_pdf_idx:
                 continue
-            if pdf_contiene_datos(p['content'], ruc_emisor, serie, numero):
-                matches_lines.append(f"{id_xml} → {p['filename']}")
+            if any(_pagina_contiene(t, ruc_emisor, serie, numero) for t in textos_pdf_idx[j]):
+                p_name, p_content = pdf_files[j]
+                matches_lines.append(f"{id_xml} → {p_name}")
                 usados_pdf_idx.add(j)
                 nombre_base = f"{(ruc_pagador or 'SINRUC')}-{id_xml}"
-                resultado_ordenado.append((f"ORDENADO/{nombre_base}.xml", x['content']))
-                resultado_ordenado.append((f"ORDENADO/{nombre_base}.pdf", p['content']))
+                resultado_ordenado.append((f"ORDENADO/{nombre_base}.xml", x_content))
+                resultado_ordenado.append((f"ORDENADO/{nombre_base}.pdf", p_content))
                 encontrado = True
                 break
         if not encontrado:
-            errores.append(f"{x['filename']} → ⚠ Sin PDF emparejado")
+            errores.append(f"{x_name} → ⚠ Sin PDF emparejado")
         reporte_rows.append({
-            "XML_Original": x['filename'],
+            "XML_Original": x_name,
             "RUC_Emisor": ruc_emisor,
             "Emisor_DEP": sup_subentity, "Emisor_PROV": sup_city, "Emisor_DIST": sup_district,
             "UBIGEO_Emisor": ubi_sup,
@@ -233,23 +439,26 @@ def emparejar_y_reportar(xml_files, pdf_files, df_ubi):
     if reporte_rows:
         df_rep = pd.DataFrame(reporte_rows)
         excel_report_buffer = io.BytesIO()
-        with pd.ExcelWriter(excel_report_buffer, engine='openpyxl') as writer:
-            df_rep.to_excel(writer, index=False, sheet_name="Reporte")
+        wb, fmt_header = _nuevo_xlsx(excel_report_buffer)
+        _escribir_hoja(wb, fmt_header, "Reporte", df_rep)
+        wb.close()
         excel_report_buffer.seek(0)
     return resultado_ordenado, excel_report_buffer, reporte_emparejamientos_txt, reporte_errores_txt
 
-def build_id_facturas_por_ruc(xml_files):
-    idx = {}
-    for x in xml_files:
-        (id_xml, ruc_emisor, _ruc_pagador, serie, numero, *_rest) = extraer_datos_xml_bytes(x['content'])
+def build_id_facturas_por_ruc(xml_files, executor=None, datos=None):
+    idx = defaultdict(set)
+    if datos is None:
+        datos = extraer_datos_xmls(xml_files, executor)
+    for extracted in datos:
+        (id_xml, ruc_emisor, _ruc_pagador, serie, numero, *_rest) = extracted
         if not (id_xml and ruc_emisor and serie and numero):
             continue
-        idx.setdefault(str(ruc_emisor).strip(), set()).add(str(id_xml).strip())
-    return idx
+        idx[str(ruc_emisor).strip()].add(str(id_xml).strip())
+    return dict(idx)   # dict normal: un .get/[] posterior no crea claves
 
 def validar_confirming_excel(file_bytes, id_facturas_por_ruc=None):
-    import pandas as pd, io as _io, re
-    xls = pd.ExcelFile(_io.BytesIO(file_bytes))
+    import pandas as pd, io as _io
+    xls = pd.ExcelFile(_io.BytesIO(file_bytes), engine=EXCEL_ENGINE)
     required_cols = {"RUC", "Razón Social Proveedor", "Tipo Doc.", "Documento", "Vence",
                      "Moneda", "Monto Neto a Pagar", "Banco", "Cta Bancaria", "CCI", "Tipo cuenta"}
     hoja_obj = None
@@ -268,21 +477,23 @@ def validar_confirming_excel(file_bytes, id_facturas_por_ruc=None):
         return str(s).strip() if s is not None else ""
 
     def norm_upper(s):
-        import unicodedata
-        s = nz(s).upper()
-        return ''.join(c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn')
+        return normaliza(nz(s))
+
+    @lru_cache(maxsize=None)   # pocas fechas distintas por hoja: cada texto se prueba una vez
+    def _fecha_texto_valida(texto):
+        for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d"):
+            try:
+                datetime.strptime(texto, fmt)
+                return True
+            except ValueError:
+                continue
+        return False
 
     def validar_fecha(fecha):
         if isinstance(fecha, datetime):
             return True
         if isinstance(fecha, str):
-            for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y", "%Y/%m/%d"):
-                try:
-                    datetime.strptime(fecha.strip(), fmt)
-                    return True
-                except ValueError:
-                    continue
-            return False
+            return _fecha_texto_valida(fecha.strip())
         return False
 
     def validar_ruc(ruc):
@@ -333,7 +544,7 @@ def validar_confirming_excel(file_bytes, id_facturas_por_ruc=None):
 
     def _parse_doc_numero_only(doc_str):
         s = _nz(doc_str).upper()
-        m = re.match(r'^[A-Z0-9]{1,4}-(\d{1,})$', s)
+        m = DOC_NUMERO_RE.match(s)
         return m.group(1) if m else None
 
     def _split_idfact(idf):
@@ -343,107 +554,128 @@ def validar_confirming_excel(file_bytes, id_facturas_por_ruc=None):
             return None, None
         return parts[0], parts[1]
 
-    def _best_by_numeric_suffix(numero_excel, candidatos):
-        if not candidatos:
-            return None
-        num_x = _nz(numero_excel)
-        best = None
-        best_suffix = -1
-        best_num_len = -1
+    def _trie_sufijos(candidatos):
+        """
+        Trie de los números de los candidatos leídos de derecha a izquierda. Cada nodo
+        guarda el mejor de su subárbol: el número más largo y, ante empate, el primero
+        visto (mismo desempate que la comparación candidato por candidato).
+        """
+        raiz = [{}, None, -1]   # [hijos, candidato, largo del número]
         for cand in candidatos:
             _cs, cand_num = _split_idfact(cand)
             if not cand_num:
                 continue
-            max_len = min(len(cand_num), len(num_x))
-            common = 0
-            for i in range(1, max_len + 1):
-                if cand_num[-i] == num_x[-i]:
-                    common += 1
-                else:
-                    break
-            if (common > best_suffix) or (common == best_suffix and len(cand_num) > best_num_len):
-                best = cand
-                best_suffix = common
-                best_num_len = len(cand_num)
-        return best
+            largo = len(cand_num)
+            nodo = raiz
+            if largo > nodo[2]:
+                nodo[1], nodo[2] = cand, largo
+            for ch in reversed(cand_num):
+                nodo = nodo[0].setdefault(ch, [{}, None, -1])
+                if largo > nodo[2]:
+                    nodo[1], nodo[2] = cand, largo
+        return raiz
+
+    def _best_by_numeric_suffix(numero_excel, trie):
+        # El nodo más profundo alcanzable con el número del Excel es el sufijo común
+        # más largo; su mejor candidato es el elegido. O(len(numero)), no O(candidatos).
+        nodo = trie
+        for ch in reversed(_nz(numero_excel)):
+            sig = nodo[0].get(ch)
+            if sig is None:
+                break
+            nodo = sig
+        return nodo[1]
 
     if "Documento_Original" not in df.columns:
         df["Documento_Original"] = df["Documento"]
 
+    # Filas como dicts (sin construir una Series por fila); row.get() igual que antes
     if id_facturas_por_ruc:
-        for i, row in df.iterrows():
+        documentos = df["Documento"].tolist()
+        tries = {}   # RUC -> trie de sus candidatos, armado una vez por RUC
+        for pos, row in enumerate(df.to_dict("records")):
             ruc = limpiar_numero(row.get("RUC"))
             if not validar_ruc(ruc):
                 continue
             numero_x = _parse_doc_numero_only(row.get("Documento"))
             if not numero_x:
                 continue
-            cand_set = id_facturas_por_ruc.get(ruc, set())
-            elegido = _best_by_numeric_suffix(numero_x, cand_set)
+            trie = tries.get(ruc)
+            if trie is None:
+                trie = tries[ruc] = _trie_sufijos(id_facturas_por_ruc.get(ruc, set()))
+            elegido = _best_by_numeric_suffix(numero_x, trie)
             if elegido:
-                df.at[i, "Documento"] = elegido
-
+                documentos[pos] = elegido
+        df["Documento"] = documentos   # una sola asignación de columna
+
+    # Validación por columnas: cada regla corre una vez sobre su columna completa y
+    # el motivo se arma sólo para las filas que fallan. Se evalúa con las mismas
+    # funciones de arriba (no con .str de pandas: con pyarrow las regex son RE2 y
+    # \d / \D dejan de aceptar dígitos no ASCII, que limpiar_numero sí acepta).
+    def _col(nombre):
+        return df[nombre] if nombre in df.columns else pd.Series(None, index=df.index, dtype=object)
+
+    def _regla(valores, fn, *otras):
+        return pd.Series([fn(*v) for v in zip(valores, *otras)], index=df.index, dtype=bool)
+
+    docs = [nz(v) for v in _col("Documento").tolist()]
+    bancos = _col("Banco").tolist()
+    bancos_norm = [banco_tipo(b) for b in bancos]
+    con_banco = pd.Series([b in ("BCP", "BBVA") for b in bancos_norm], index=df.index, dtype=bool)
+    ruc_ok = _regla(_col("RUC"), validar_ruc)
+
+    fallas = [
+        (~ruc_ok, "RUC inválido (11 dígitos)"),
+        (~_regla(_col("Razón Social Proveedor"), validar_razon_social), "Razón Social vacía"),
+        (~pd.Series([bool(DOC_VALIDO_RE.match(d)) for d in docs], index=df.index, dtype=bool),
+         "Documento inválido (SERIE-NUMERO)"),
+        (~_regla(_col("Vence"), validar_fecha), "Fecha inválida"),
+        (~_regla(_col("Moneda"), validar_moneda), "Moneda inválida (PEN/USD)"),
+        (~_regla(_col("Monto Neto a Pagar"), validar_monto), "Monto inválido"),
+        (con_banco & ~pd.Series([isinstance(b, str) and b.strip() != "" for b in bancos],
+                                index=df.index, dtype=bool), "Banco vacío"),
+        (con_banco & ~_regla(_col("Cta Bancaria"), validar_cta_bancaria, bancos_norm),
+         "Cuenta inválida (BCP 13-14 díg., BBVA 18 díg.)"),
+        (~_regla(_col("CCI"), validar_cci), "CCI inválido (20 dígitos)"),
+    ]
+    tipo_ok = _regla(_col("Tipo cuenta"), validar_tipo_cuenta_para_banco, bancos_norm)
+    fallas.append((~tipo_ok & con_banco, "Tipo de cuenta inválido (corriente/ahorros)"))
+    fallas.append((~tipo_ok & ~con_banco, "Tipo de cuenta inválido (solo vacío o corriente/ahorros)"))
+    if id_facturas_por_ruc:
+        def _doc_en_xml(ruc, doc):
+            candidatos = id_facturas_por_ruc.get(limpiar_numero(ruc), set())
+            return not candidatos or doc in candidatos
+        fallas.append((ruc_ok & pd.Series([bool(d) for d in docs], index=df.index, dtype=bool)
+                       & ~_regla(_col("RUC"), _doc_en_xml, docs),
+                       "Documento no coincide con XML para el RUC"))
+
+    con_error = pd.Series(False, index=df.index)
+    for mask, _motivo in fallas:
+        con_error |= mask
     errores = []
-    for idx, row in df.iterrows():
-        fila_errores = []
+    for idx in df.index[con_error.to_numpy()]:
+        errores.append({"Fila Excel": idx + 2,
+                        "Errores": "; ".join(motivo for mask, motivo in fallas if mask.at[idx])})
 
-        if not validar_ruc(row.get("RUC")): fila_errores.append("RUC inválido (11 dígitos)")
-        if not validar_razon_social(row.get("Razón Social Proveedor")): fila_errores.append("Razón Social vacía")
-
-        doc = nz(row.get("Documento"))
-        if not re.match(r'^[A-Z0-9]{1,4}-\d{1,}$', doc, flags=re.IGNORECASE):
-            fila_errores.append("Documento inválido (SERIE-NUMERO)")
-
-        if not validar_fecha(row.get("Vence")): fila_errores.append("Fecha inválida")
-        if not validar_moneda(row.get("Moneda")): fila_errores.append("Moneda inválida (PEN/USD)")
-        if not validar_monto(row.get("Monto Neto a Pagar")): fila_errores.append("Monto inválido")
-
-        banco_norm = banco_tipo(row.get("Banco"))
-        if banco_norm in ("BCP","BBVA"):
-            if not isinstance(row.get("Banco"), str) or row.get("Banco").strip()=="":
-                fila_errores.append("Banco vacío")
-
-        if not validar_cta_bancaria(row.get("Cta Bancaria"), banco_norm):
-            if banco_norm in ("BCP","BBVA"):
-                fila_errores.append("Cuenta inválida (BCP 13-14 díg., BBVA 18 díg.)")
-
-        if not validar_cci(row.get("CCI")):
-            fila_errores.append("CCI inválido (20 dígitos)")
-
-        if not validar_tipo_cuenta_para_banco(row.get("Tipo cuenta"), banco_norm):
-            if banco_norm in ("BCP","BBVA"):
-                fila_errores.append("Tipo de cuenta inválido (corriente/ahorros)")
-            else:
-                fila_errores.append("Tipo de cuenta inválido (solo vacío o corriente/ahorros)")
-
-        if id_facturas_por_ruc and validar_ruc(row.get("RUC")) and doc:
-            ruc_key = limpiar_numero(row.get("RUC"))
-            candidatos = id_facturas_por_ruc.get(ruc_key, set())
-            if candidatos and doc not in candidatos:
-                fila_errores.append("Documento no coincide con XML para el RUC")
-
-        if fila_errores:
-            errores.append({"Fila Excel": idx + 2, "Errores": "; ".join(fila_errores)})
-
-    def fila_valida(row):
-        return not any(e["Fila Excel"] == row.name + 2 for e in errores)
-
-    mask_valid = df.apply(fila_valida, axis=1)
-    df_validado = df[mask_valid].copy()
+    df_validado = df[~con_error].copy()
 
     validado_buffer = _io.BytesIO()
-    with pd.ExcelWriter(validado_buffer, engine='openpyxl') as writer:
-        if df_validado.empty:
-            pd.DataFrame(columns=df.columns).to_excel(writer, sheet_name="SIN_VALIDOS", index=False)
-        else:
-            for moneda in df_validado["Moneda"].dropna().astype(str).str.upper().unique():
-                df_moneda = df_validado[df_validado["Moneda"].astype(str).str.upper() == moneda]
-                if not df_moneda.empty:
-                    df_moneda.to_excel(writer, sheet_name=moneda, index=False)
+    wb, fmt_header = _nuevo_xlsx(validado_buffer)
+    if df_validado.empty:
+        _escribir_hoja(wb, fmt_header, "SIN_VALIDOS", pd.DataFrame(columns=df.columns))
+    else:
+        monedas = df_validado["Moneda"].astype(str).str.upper()
+        for moneda in df_validado["Moneda"].dropna().astype(str).str.upper().unique():
+            df_moneda = df_validado[monedas == moneda]
+            if not df_moneda.empty:
+                _escribir_hoja(wb, fmt_header, moneda, df_moneda)
+    wb.close()
     validado_buffer.seek(0)
 
     errores_buffer = _io.BytesIO()
-    pd.DataFrame(errores).to_excel(errores_buffer, index=False, engine='openpyxl')
+    wb, fmt_header = _nuevo_xlsx(errores_buffer)
+    _escribir_hoja(wb, fmt_header, "Sheet1", pd.DataFrame(errores))
+    wb.close()
     errores_buffer.seek(0)
 
     errores_txt = "### REPORTE_ERRORES_VALIDACION\n" + "\n".join(
@@ -451,3 +683,138 @@ def validar_confirming_excel(file_bytes, id_facturas_por_ruc=None):
     ) if errores else "### REPORTE_ERRORES_VALIDACION\n✅ Sin errores."
 
     return validado_buffer, errores_buffer, errores_txt
+
+
+# ===== ZIP DE SALIDA =====
+ZIP_LEVEL = 1   # descarga interactiva y efímera: nivel rápido (~10 % más grande que el 6)
+ZIP_STORED, ZIP_DEFLATED = 0, 8
+# PDF y XLSX ya vienen comprimidos por dentro: DEFLATE apenas gana 1-3 % y gasta CPU
+ZIP_STORED_EXTS = (".pdf", ".xlsx")
+ZIP_STORED_MAGIC = (b"%PDF", b"PK\003\004")   # mismo criterio por contenido (PDF, ZIP/XLSX)
+
+_ZIP_LOCAL = struct.Struct("<4s2B4HL2L2H")
+_ZIP_CENTRAL = struct.Struct("<4s4B4HL2L5H2L")
+_ZIP_END = struct.Struct("<4s4H2LH")
+_ZIP32_MAX_BYTES = 0xFFFFFFFF     # tamaños/offsets de 32 bits (más allá hace falta ZIP64)
+_ZIP32_MAX_ENTRADAS = 0xFFFF
+
+def _sin_zip64(valor: int, limite: int, que: str):
+    if valor > limite:
+        raise ValueError(f"El ZIP resultante necesita ZIP64 ({que}: {valor} > {limite}); "
+                         f"divide los archivos en lotes más chicos.")
+
+def _dos_datetime(ts=None):
+    t = time.localtime(ts)
+    dosdate = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dostime = t.tm_hour << 11 | t.tm_min << 5 | (t.tm_sec // 2)
+    return dosdate, dostime
+
+def _deflate_raw(content: bytes, level: int = ZIP_LEVEL) -> bytes:
+    if _HAS_LIBDEFLATE:
+        return deflate.deflate_compress(bytes(content), level)
+    co = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return co.compress(content) + co.flush()
+
+def compress_entry(name: str, content, level: int = ZIP_LEVEL):
+    """
+    Prepara una entrada -> (name, method, crc32, comp_bytes, usize).
+    PDF/XLSX (por extensión o por firma) se guardan sin comprimir (ZIP_STORED), igual
+    que cualquier entrada que DEFLATE no logre achicar. Libera el GIL (zlib/libdeflate).
+    `content` puede ser un archivo abierto: se lee recién aquí.
+    """
+    if hasattr(content, "read"):
+        content = read_all(content)
+    usize = memoryview(content).nbytes
+    crc = zlib.crc32(content)
+    if name.lower().endswith(ZIP_STORED_EXTS) or bytes(memoryview(content)[:4]).startswith(ZIP_STORED_MAGIC):
+        return name, ZIP_STORED, crc, content, usize
+    comp = _deflate_raw(content, level)
+    if len(comp) >= usize:
+        return name, ZIP_STORED, crc, content, usize
+    return name, ZIP_DEFLATED, crc, comp, usize
+
+class LibdeflateZipWriter:
+    """
+    Escritor ZIP mínimo: comprime cada entrada de una sola vez con libdeflate
+    (o zlib si no está instalado; PDF/XLSX van en STORED) y escribe a mano cabeceras locales,
+    directorio central y EOCD. No soporta ZIP64 (límite 4 GB / 65535 entradas): si hiciera
+    falta, ValueError con el motivo.
+    """
+    def __init__(self, fp, level: int = ZIP_LEVEL):
+        self.fp = fp
+        self.level = level
+        self._central = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def writestr(self, name: str, content: bytes):
+        self.write_compressed(*compress_entry(name, content, self.level))
+
+    def write_compressed(self, name: str, method: int, crc: int, comp: bytes, usize: int):
+        """Agrega una entrada ya preparada (salida de compress_entry)."""
+        fname = name.encode("utf-8")
+        csize = memoryview(comp).nbytes
+        dosdate, dostime = _dos_datetime()
+        offset = self.fp.tell()
+        _sin_zip64(max(csize, usize), _ZIP32_MAX_BYTES, f"tamaño de '{name}'")
+        _sin_zip64(offset, _ZIP32_MAX_BYTES, "tamaño total")
+        self.fp.write(_ZIP_LOCAL.pack(
+            b"PK\003\004", 20, 0, 0x800, method, dostime, dosdate,
+            crc, csize, usize, len(fname), 0
+        ))
+        self.fp.write(fname)
+        self.fp.write(comp)
+        self._central.append((fname, method, crc, csize, usize, dosdate, dostime, offset))
+
+    def close(self):
+        cd_start = self.fp.tell()
+        for fname, method, crc, csize, usize, dosdate, dostime, offset in self._central:
+            self.fp.write(_ZIP_CENTRAL.pack(
+                b"PK\001\002", 20, 3, 20, 0, 0x800, method, dostime, dosdate,
+                crc, csize, usize, len(fname), 0, 0, 0, 0, 0o600 << 16, offset
+            ))
+            self.fp.write(fname)
+        cd_size = self.fp.tell() - cd_start
+        n = len(self._central)
+        _sin_zip64(n, _ZIP32_MAX_ENTRADAS, "cantidad de archivos")
+        _sin_zip64(cd_start + cd_size, _ZIP32_MAX_BYTES, "tamaño total")
+        self.fp.write(_ZIP_END.pack(b"PK\005\006", 0, 0, n, n, cd_size, cd_start, 0))
+
+def construir_zip_resultado(resultado_ordenado, excel_report_buffer=None):
+    """
+    ZIP final: archivos ORDENADO/* + reporte_ubigeo.xlsx (si existe).
+    Se escribe en un archivo temporal en disco (se borra solo al cerrarse) y se
+    devuelve abierto y posicionado al inicio; pásalo tal cual a st.download_button.
+    """
+    # Limpia la notación de ruta de archivos anidados
+    entradas = [(name.replace("!/", "__"), content) for name, content in resultado_ordenado]
+    if excel_report_buffer is not None:
+        entradas.append(("reporte_ubigeo.xlsx", excel_report_buffer.getbuffer()))
+
+    with tempfile.TemporaryFile(suffix=".zip") as tmp:
+        with LibdeflateZipWriter(tmp) as zf, ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+            # Comprime en paralelo; escribe en el orden original
+            for entry in pool.map(lambda e: compress_entry(*e), entradas):
+                zf.write_compressed(*entry)
+        return archivo_para_descarga(tmp)
+
+def archivo_para_descarga(tmp):
+    """
+    Archivo temporal ya escrito -> mismo contenido abierto en "rb" y al inicio
+    (st.download_button sólo acepta BufferedReader, no BufferedRandom). El temporal
+    se puede cerrar después: el archivo sigue vivo mientras el devuelto esté abierto.
+    Quien lo guarde en session_state lo cierra con cerrar_descarga al reemplazarlo.
+    """
+    tmp.flush()
+    f = open(os.dup(tmp.fileno()), "rb")
+    f.seek(0)
+    return f
+
+def cerrar_descarga(f):
+    """Cierra un archivo de archivo_para_descarga (libera el descriptor y el temporal); ignora lo demás."""
+    if isinstance(f, io.IOBase):
+        f.close()
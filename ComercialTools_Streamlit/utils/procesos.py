@@ -0,0 +1,27 @@
+"""
+Pool de procesos compartido por las páginas (extracción de comprimidos y parseo de XML).
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import streamlit as st
+
+from utils.archivos import MP_CONTEXT
+
+
+@st.cache_resource(show_spinner=False)
+def _pool_cacheado():
+    return ProcessPoolExecutor(max_workers=os.cpu_count() or 1, mp_context=MP_CONTEXT)
+
+def pool_procesos():
+    """
+    Un solo pool por servidor para todas las páginas. Si un hijo murió el pool queda
+    roto para siempre (BrokenExecutor): se descarta y se crea otro, en vez de que cada
+    corrida siguiente caiga en silencio al camino en serie.
+    """
+    pool = _pool_cacheado()
+    if getattr(pool, "_broken", False):
+        pool.shutdown(wait=False, cancel_futures=True)
+        _pool_cacheado.clear()
+        pool = _pool_cacheado()
+    return pool
@@ -0,0 +1,284 @@
+"""
+Metadatos de comprobantes UBL (RUC emisor, tipo, serie, correlativo) leídos
+del contenido XML. Sin dependencias de Streamlit para poder ejecutarse en
+procesos hijos (ProcessPoolExecutor).
+"""
+import hashlib, itertools, math, os, re
+import xml.etree.ElementTree as ET
+from concurrent.futures import BrokenExecutor
+from typing import Dict, List, Optional
+
+from utils.archivos import as_fileobj, read_all
+
+try:
+    from lxml import etree as LET
+    _HAS_LXML = True
+except Exception:
+    _HAS_LXML = False
+
+PARALLEL_MIN_XML = 8   # por debajo, el arranque del pool cuesta más que el parseo
+DEDUP_MIN_BYTES  = 4096   # por debajo, hashear cuesta casi lo mismo que parsear
+
+# Regex precompiladas (se usan por archivo / por fila)
+DOC_RE      = re.compile(r"([A-Z]{1,3}\d{1,4})\D?(\d{1,12})")   # serie + correlativo
+DOC_RE_I    = re.compile(DOC_RE.pattern, re.IGNORECASE)
+NON_DIGIT   = re.compile(r"\D")
+WHITESPACE  = re.compile(r"\s+")
+# Fallback sobre los bytes crudos (sin decodificar todo el XML)
+ID_RE       = re.compile(rb"<cbc:ID[^>]*>(.*?)</cbc:ID>", re.IGNORECASE | re.DOTALL)
+SCHEME6_RE  = re.compile(rb'schemeID\s*=\s*"6"[^>]*>\s*([0-9]{11})\s*<', re.IGNORECASE)
+TIPO_RE     = re.compile(rb"<cbc:(?:InvoiceTypeCode|CreditNoteTypeCode|DebitNoteTypeCode)[^>]*>\s*([0-9]{2})\s*<", re.IGNORECASE)
+# Vía rápida sobre bytes (mismas reglas que el recorrido con parser)
+_TAG_ID_RE   = re.compile(rb"<(?:[A-Za-z_][\w.-]*:)?ID(?=[\s/>])([^<>]*)>")
+_TAG_TIPO_RE = re.compile(rb"<(?:[A-Za-z_][\w.-]*:)?(InvoiceTypeCode|CreditNoteTypeCode|DebitNoteTypeCode)(?=[\s/>])([^<>]*)>")
+_SCHEME_ID_RE = re.compile(rb"""(?:^|\s)schemeID\s*=\s*(["'])(.*?)\1""", re.DOTALL)
+_ESPECIALES_RE = re.compile(rb"<!\[CDATA\[.*?\]\]>|<!--.*?-->|<\?.*?\?>", re.DOTALL)
+_ENCODING_RE = re.compile(rb"""^(?:\xef\xbb\xbf)?<\?xml[^>]*?encoding\s*=\s*["']([A-Za-z0-9._-]+)["']""")
+_ENCODINGS_ASCII = {"utf-8", "utf8", "us-ascii", "ascii", "iso-8859-1", "latin-1", "latin1", "windows-1252", "cp1252"}
+
+
+# ====================== HELPERS ======================
+def _to_safe_str(v) -> str:
+    """Convierte a str de forma segura (soporta int/float/None/NaN)."""
+    if v is None:
+        return ""
+    if isinstance(v, float) and math.isnan(v):
+        return ""
+    s = str(v)
+    if s.lower() == "nan":
+        return ""
+    return s.strip()
+
+def _solo_digitos(s: str) -> str:
+    """Quita todo lo que no sea dígito; sin pasar por la regex si ya lo es (caso normal del RUC)."""
+    return s if s.isdecimal() else NON_DIGIT.sub("", s)
+
+
+# ====================== PARSEO DE XML (CANÓNICO) ======================
+_TIPO_TAGS = ("InvoiceTypeCode", "CreditNoteTypeCode", "DebitNoteTypeCode")
+
+def _set_id(meta, doc_id: str):
+    """ID del comprobante -> id_full, serie, corr."""
+    meta["id_full"] = doc_id
+    if "-" in doc_id:
+        s, c = doc_id.split("-", 1)
+        meta["serie"] = s.strip().upper()
+        meta["corr"]  = c.strip()
+    else:
+        m = DOC_RE.search(doc_id.upper())
+        if m:
+            meta["serie"] = m.group(1)
+            meta["corr"]  = m.group(2)
+
+def _meta_rapida(xml_bytes: bytes) -> Optional[Dict[str, Optional[str]]]:
+    """
+    ID, RUC (schemeID="6") y tipo con regex sobre los bytes, sin parser XML.
+    Devuelve None (y se usa el parser) si falta alguno de los tres o si el XML tiene
+    algo que las regex no interpretan igual que el parser: DOCTYPE, entidades en los
+    valores, CDATA/comentarios/PI antes de lo encontrado o una codificación no ASCII.
+    """
+    if xml_bytes[:2] in (b"\xff\xfe", b"\xfe\xff"):
+        return None
+    enc = _ENCODING_RE.match(xml_bytes)
+    encoding = enc.group(1).decode("ascii").lower() if enc else "utf-8"
+    if encoding not in _ENCODINGS_ASCII:
+        return None
+
+    def _texto(m):
+        """Texto del elemento (None si vacío); False si no es texto simple."""
+        attrs = m.group(m.lastindex)
+        if attrs.count(b'"') % 2 or attrs.count(b"'") % 2:
+            return False   # un '>' dentro de un atributo cortó la etiqueta
+        if attrs.endswith(b"/"):
+            return None
+        fin = xml_bytes.find(b"<", m.end())
+        if fin < 0 or xml_bytes[fin + 1:fin + 2] != b"/":
+            return False
+        raw = xml_bytes[m.end():fin]
+        if b"&" in raw:
+            return False
+        try:
+            return raw.decode(encoding) if raw else None
+        except UnicodeDecodeError:
+            return False
+
+    ids = _TAG_ID_RE.finditer(xml_bytes)
+    m_id = next(ids, None)
+    if m_id is None or xml_bytes.find(b"<!DOCTYPE", 0, m_id.start()) >= 0:
+        return None   # el DOCTYPE va antes del elemento raíz
+    usados = [m_id]
+
+    m_ruc = None
+    for m in itertools.chain((m_id,), ids):
+        sch = _SCHEME_ID_RE.search(m.group(1))
+        if sch and sch.group(2).strip() == b"6":
+            t = _texto(m)
+            if t is False:
+                return None
+            if len(_solo_digitos(t or "")) == 11:
+                m_ruc = m
+                break
+    if m_ruc is None:
+        return None
+    usados.append(m_ruc)
+
+    # Primera aparición de cada tipo, como el parser: hasta el primer InvoiceTypeCode
+    # (prioridad máxima) o, si no hay, en todo el documento
+    tipos = {}
+    for m in _TAG_TIPO_RE.finditer(xml_bytes):
+        tag = m.group(1).decode("ascii")
+        if tag not in tipos:
+            tipos[tag] = m
+            usados.append(m)
+            if tag == _TIPO_TAGS[0]:
+                break
+    if not tipos:
+        return None
+
+    # Lo encontrado no debe caer dentro de un CDATA, comentario o PI. Sin endpos: un bloque
+    # que empieza antes de `limite` debe poder cerrar después para que se lo detecte
+    limite = max(m.end() for m in usados)
+    for esp in _ESPECIALES_RE.finditer(xml_bytes):
+        if esp.start() >= limite:
+            break
+        if any(esp.start() < m.start() < esp.end() for m in usados):
+            return None
+
+    meta = {"ruc": None, "tipo": None, "serie": None, "corr": None, "id_full": None}
+    t_id = _texto(m_id)
+    if t_id is False:
+        return None
+    if t_id:
+        _set_id(meta, t_id.strip())
+    meta["ruc"] = _solo_digitos(_texto(m_ruc))
+    for t in _TIPO_TAGS:
+        if t in tipos:
+            t_tipo = _texto(tipos[t])
+            if t_tipo is False:
+                return None
+            if t_tipo:
+                meta["tipo"] = _to_safe_str(t_tipo)
+            break
+    return meta
+
+def _extract_xml_meta(xml_src) -> Dict[str, Optional[str]]:
+    """
+    Devuelve dict con:
+      - ruc: RUC emisor (11 dígitos)
+      - tipo: '01'/'03'/etc. si se encuentra
+      - serie: p.ej. 'F001'
+      - corr: p.ej. '00005905' (padding exacto del XML)
+      - id_full: p.ej. 'F001-00005905'
+    Intenta UBL estándar Perú y es tolerante a namespaces.
+    `xml_src` puede ser bytes o un archivo abierto.
+    Primero intenta la vía rápida por regex (_meta_rapida); si no alcanza, recorre
+    el XML con el parser.
+    """
+    xml_bytes = read_all(xml_src)
+    rapida = _meta_rapida(xml_bytes)
+    if rapida is not None:
+        return rapida
+
+    meta = {"ruc": None, "tipo": None, "serie": None, "corr": None, "id_full": None}
+    try:
+        # Recorrido en streaming: se corta apenas se tienen ID, RUC e InvoiceTypeCode,
+        # sin construir el árbol completo (las líneas del comprobante no se leen).
+        # Sin InvoiceTypeCode se lee hasta el final: sólo así se descarta que aparezca
+        # después de un CreditNote/DebitNoteTypeCode y se respeta la prioridad.
+        # lxml con las mismas opciones que core._lxml(): sin comentarios ni PI (si no,
+        # el .text se corta en un comentario en línea), sólo entidades internas
+        if _HAS_LXML:
+            eventos = LET.iterparse(as_fileobj(xml_bytes), events=("end",), remove_comments=True,
+                                    remove_pis=True, resolve_entities="internal")
+        else:
+            eventos = ET.iterparse(as_fileobj(xml_bytes), events=("end",))
+        id_node_seen = False
+        tipos = {}
+        for _, el in eventos:
+            tag = el.tag.rpartition("}")[2] if isinstance(el.tag, str) else ""
+
+            if tag == "ID":
+                # ID del comprobante (primer cbc:ID del documento)
+                if not id_node_seen:
+                    id_node_seen = True
+                    if el.text:
+                        _set_id(meta, el.text.strip())
+
+                # RUC emisor (schemeID="6")
+                if meta["ruc"] is None and (el.get("schemeID") or "").strip() == "6":
+                    r_digits = _solo_digitos(el.text or "")
+                    if len(r_digits) == 11:
+                        meta["ruc"] = r_digits
+
+            elif tag in _TIPO_TAGS and tag not in tipos:
+                tipos[tag] = el.text
+
+            if id_node_seen and meta["ruc"] is not None and _TIPO_TAGS[0] in tipos:
+                break
+
+            # libera lo ya procesado
+            el.clear()
+            if _HAS_LXML:
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+
+        # Tipo (prioridad Invoice > CreditNote > DebitNote)
+        for t in _TIPO_TAGS:
+            if t in tipos:
+                if tipos[t]:
+                    meta["tipo"] = _to_safe_str(tipos[t])
+                break
+
+    except Exception:
+        # fallback regex (sobre bytes; sólo se decodifica lo capturado)
+        m = ID_RE.search(xml_bytes)
+        if m:
+            id_full = WHITESPACE.sub("", m.group(1).decode("utf-8", "ignore"))
+            meta["id_full"] = id_full
+            mm = DOC_RE_I.search(id_full)
+            if mm:
+                meta["serie"] = mm.group(1).upper()
+                meta["corr"]  = mm.group(2)
+        m2 = SCHEME6_RE.search(xml_bytes)
+        if m2:
+            meta["ruc"] = m2.group(1).decode("ascii")
+        m3 = TIPO_RE.search(xml_bytes)
+        if m3:
+            meta["tipo"] = m3.group(1).decode("ascii")
+
+    if meta["serie"]:
+        meta["serie"] = meta["serie"].upper()
+    return meta
+
+
+# ====================== LOTES ======================
+def extraer_metas_xml(payloads: List, executor=None) -> List[Dict[str, Optional[str]]]:
+    """
+    _extract_xml_meta sobre cada contenido (bytes o archivo), en el mismo orden.
+    Con un executor (ProcessPoolExecutor) y lotes de al menos PARALLEL_MIN_XML
+    archivos, el parseo se reparte entre procesos (se les envían los bytes).
+    Los contenidos idénticos (el mismo XML reenviado en varios comprimidos) se
+    parsean una sola vez; cada posición recibe su propia copia del dict.
+    """
+    unicos, posicion, vistos = [], [], {}
+    for b in payloads:
+        data = read_all(b)
+        clave = hashlib.blake2b(data, digest_size=16).digest() if len(data) >= DEDUP_MIN_BYTES else None
+        if clave is None or clave not in vistos:
+            if clave is not None:
+                vistos[clave] = len(unicos)
+            posicion.append(len(unicos))
+            unicos.append(data)
+        else:
+            posicion.append(vistos[clave])
+
+    if executor is None or len(unicos) < PARALLEL_MIN_XML:
+        metas = [_extract_xml_meta(b) for b in unicos]
+    else:
+        chunksize = max(1, len(unicos) // (4 * (os.cpu_count() or 1)))
+        try:
+            metas = list(executor.map(_extract_xml_meta, unicos, chunksize=chunksize))
+        except BrokenExecutor:
+            # un proceso hijo murió: se repite en serie
+            metas = [_extract_xml_meta(b) for b in unicos]
+    return [dict(metas[i]) for i in posicion]